@@ -1,11 +1,20 @@
 import torch
 import torchvision
+import numpy as np
 import pandas as pd
 from torch.utils import data
+import hashlib
+import io
+import itertools
+import json
+import mmap
 import os
 import random
+import tarfile
+import time
 from PIL import Image
 import config as cfg
+from Module.checkpoint import write_atomic
 import pdb
 from torchvision import datasets, transforms, models
 
@@ -13,14 +22,17 @@ from torchvision import datasets, transforms, models
 class CelebA(data.Dataset):
     
     # each image is  218*178;
+    # decode_size: (width, height), let libjpeg decode the images at the smallest
+    # 1/2, 1/4 or 1/8 scale that still covers it, instead of the full size.
     def __init__(self, attr_file, selected_attrs, image_folder,
-                transform, mode = "train"):
+                transform, mode = "train", decode_size = None):
 
         #self.read_bbox_file(bbox_file)
         self.attr_file = attr_file
         self.image_folder = image_folder
         self.transform = transform
         self.selected_attrs = selected_attrs
+        self.decode_size = decode_size
 
         self.train_dataset = []
         self.validate_dataset = []
@@ -42,57 +54,33 @@ class CelebA(data.Dataset):
         return self.num_images
     
     def __getitem__(self, index):
-        """Return image data (tensor) and labels (dict)"""
-        dataset = self.train_dataset
-        if self.mode == 'validate':
-            dataset = self.validate_dataset
-        elif self.mode == "test":
-            dataset = self.test_dataset
-        filename, label = dataset[index]
-        image = Image.open(os.path.join(self.image_folder, filename)) 
+        """Return image data (tensor) and labels ([num_attr] tensor)"""
+        samples = self.split_dataset()
+        image = self.load_image(samples.filename(index), index)
+        if self.decode_size != None:
+            image.draft('RGB', self.decode_size)
         if self.transform != None:
             image = self.transform(image)
-        return image, label
+        return image, samples.label(index)
+
+    def split_dataset(self):
+        """The samples of the current mode."""
+        if self.mode == 'validate':
+            return self.validate_dataset
+        elif self.mode == "test":
+            return self.test_dataset
+        return self.train_dataset
+
+    def load_image(self, filename, index):
+        return Image.open(os.path.join(self.image_folder, filename))
 
     def preprocess(self):
-        lines = [line.rstrip() for line in open(self.attr_file, 'r')]
-        all_attr_names = lines[1].split()
+        all_attr_names, splits = load_split_index(self.attr_file, self.selected_attrs)
         for i, attr_name in enumerate(all_attr_names):
             self.attr2idx[attr_name] = i
             self.idx2attr[i] = attr_name
+        self.train_dataset, self.validate_dataset, self.test_dataset = splits
 
-        lines = lines[2:]
-        random.seed(1024)
-        random.shuffle(lines)
-
-        for i, line in enumerate(lines):
-            split = line.split()
-            filename = split[0]
-            values = split[1:]
-           
-            label = []
-            # save the attributes into a dict
-            for attr_name in self.selected_attrs:
-            
-                idx = self.attr2idx[attr_name]
-                val = int(values[idx])
-                if val == -1:
-                    val = 0
-                label.append(val)
-
-            # split the data by index.
-            if (i+1) < cfg.train_end_index:
-                self.train_dataset.append([filename, label])
-
-            elif (i + 1) < cfg.validate_end_index:
-                self.validate_dataset.append([filename, label])
-
-            elif (i + 1) < cfg.test_end_index:
-                self.test_dataset.append([filename, label])
-                
-            elif i >= cfg.test_end_index:
-                break 
-                
         print('Finished preprocessing the CelebA data set...')
 
 
@@ -151,51 +139,616 @@ class CelebA(data.Dataset):
             return partition_frame
      
 
-def collate_fn(batch_data):
+class SplitSamples(object):
     """
-    batch_data = [{'image': [batch_size, 3, 224, 224], 'label': [batch_size, num_attr]}]
+    The samples of a split in a few flat arrays instead of python lists: the
+    filenames are concatenated in one byte buffer located by offsets, and the
+    labels of an image are bit-packed into one uint64. Forked DataLoader workers
+    reading them touch no refcounts, so the pages stay shared with the parent.
     """
-    new_batch = {'image': None, 'label': None}
+    def __init__(self, filenames, labels):
+        filenames = np.asarray(filenames, dtype=np.bytes_)
+        if labels.shape[1] > 64:
+            raise ValueError("can't pack {} attributes into a uint64".format(labels.shape[1]))
+        self.num_attrs = labels.shape[1]
+        self.name_buffer = np.frombuffer(b"".join(filenames.tolist()), dtype=np.uint8)
+        self.name_offsets = np.zeros(len(filenames) + 1, dtype=np.int64)
+        np.cumsum(np.char.str_len(filenames), out=self.name_offsets[1:])
+        self.shifts = np.arange(self.num_attrs, dtype=np.uint64)
+        self.labels = np.bitwise_or.reduce(np.asarray(labels, dtype=np.uint64) << self.shifts, axis=1)
 
-    new_images = None
-    new_labels = None
-    for idx, batch in enumerate(batch_data):
-        image = batch['image']
-        label = batch['label']
+    @classmethod
+    def from_arrays(cls, name_buffer, name_offsets, labels, num_attrs):
+        """Rebuild the samples from the arrays returned by arrays()."""
+        samples = cls.__new__(cls)
+        samples.num_attrs = int(num_attrs)
+        samples.name_buffer = name_buffer
+        samples.name_offsets = name_offsets
+        samples.shifts = np.arange(samples.num_attrs, dtype=np.uint64)
+        samples.labels = labels
+        return samples
 
-        if idx == 0:
-            new_images = image.unsqueeze(0)
-            new_labels = torch.tensor(label).unsqueeze(0)
+    def arrays(self):
+        return self.name_buffer, self.name_offsets, self.labels, self.num_attrs
+
+    def __len__(self):
+        return len(self.labels)
+
+    def filename(self, index):
+        return self.name_buffer[self.name_offsets[index]:self.name_offsets[index + 1]].tobytes().decode()
+
+    def label(self, index):
+        """Return the label of an image as a [num_attr] int64 tensor."""
+        return torch.from_numpy(((self.labels[index] >> self.shifts) & 1).astype(np.int64))
+
+    def filenames(self):
+        lengths = np.diff(self.name_offsets)
+        if len(lengths) > 0 and (lengths == lengths[0]).all():
+            # the CelebA filenames are all 10 bytes, the buffer is already a fixed width array.
+            return self.name_buffer.view('S{}'.format(lengths[0]))
+        return np.array([self.filename(i) for i in range(len(self))], dtype=np.bytes_)
+
+    def label_matrix(self):
+        return ((self.labels[:, None] >> self.shifts) & 1).astype(np.int8)
+
+
+class PackedCelebA(CelebA):
+    """
+    Read the images of a split from one container file built by pack_images:
+    the raw jpg bytes are concatenated in <mode>.bin and located by the
+    (offset, length) rows of <mode>.index.npy, then decoded from memory.
+    """
+    def __init__(self, attr_file, selected_attrs, pack_folder,
+                transform, mode = "train", decode_size = None):
+        super(PackedCelebA, self).__init__(attr_file, selected_attrs, pack_folder, transform, mode,
+                                           decode_size)
+        self.container_path = os.path.join(pack_folder, mode + ".bin")
+        self.index = np.load(os.path.join(pack_folder, mode + ".index.npy"), mmap_mode='r')
+        filenames = np.load(os.path.join(pack_folder, mode + ".filenames.npy"), mmap_mode='r')
+        if not np.array_equal(filenames, self.split_dataset().filenames()):
+            raise ValueError("The {} container in {} doesn't match the current split, "
+                             "run `python prepare_data.py pack` again.".format(mode, pack_folder))
+        self.container = None
+        self.container_pid = None
+
+    def __getstate__(self):
+        # the mapping can't be pickled, every worker process maps the container again.
+        state = self.__dict__.copy()
+        state['container'] = None
+        state['container_pid'] = None
+        return state
+
+    def load_image(self, filename, index):
+        if self.container_pid != os.getpid():
+            with open(self.container_path, 'rb') as f:
+                self.container = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.container_pid = os.getpid()
+        offset, length = self.index[index]
+        return Image.open(io.BytesIO(self.container[offset:offset + length]))
+
+
+def pack_images(image_dir, attr_path, pack_dir):
+    """
+    Pack the jpg files of every split into <pack_dir>/<mode>.bin with the
+    (offset, length) index of each image, in the same order as the split.
+    """
+    dataset = CelebA(attr_path, cfg.all_attrs, image_dir, None)
+    if not os.path.exists(pack_dir):
+        os.makedirs(pack_dir)
+    for mode, split in [("train", dataset.train_dataset),
+                        ("validate", dataset.validate_dataset),
+                        ("test", dataset.test_dataset)]:
+        container_path = os.path.join(pack_dir, mode + ".bin")
+        index = np.zeros((len(split), 2), dtype=np.int64)
+        offset = 0
+        with open(container_path + ".tmp", 'wb') as container:
+            for i, filename in enumerate(split.filenames()):
+                with open(os.path.join(image_dir, filename.decode()), 'rb') as f:
+                    image_bytes = f.read()
+                container.write(image_bytes)
+                index[i] = offset, len(image_bytes)
+                offset += len(image_bytes)
+        os.replace(container_path + ".tmp", container_path)
+        np.save(os.path.join(pack_dir, mode + ".index.npy"), index)
+        np.save(os.path.join(pack_dir, mode + ".filenames.npy"), split.filenames())
+        print("Packed {} {} images into {} ({} MB)".format(len(split), mode, container_path, offset // 2**20))
+
+
+class DecodedCelebA(CelebA):
+    """
+    Read the images of a split already decoded by decode_images: <mode>.images.npy
+    is a N*218*178*3 uint8 array memory-mapped copy-on-write, so the workers share
+    one copy through the page cache, and <mode>.labels.npy is the sidecar label array.
+    There is nothing left to decode, decode_size is ignored.
+    """
+    def __init__(self, attr_file, selected_attrs, decoded_folder,
+                transform, mode = "train", decode_size = None):
+        super(DecodedCelebA, self).__init__(attr_file, selected_attrs, decoded_folder, transform, mode)
+        self.images = np.load(os.path.join(decoded_folder, mode + ".images.npy"), mmap_mode='c')
+        self.labels = np.load(os.path.join(decoded_folder, mode + ".labels.npy"), mmap_mode='r')
+        filenames = np.load(os.path.join(decoded_folder, mode + ".filenames.npy"), mmap_mode='r')
+        if not np.array_equal(filenames, self.split_dataset().filenames()):
+            raise ValueError("The {} shard in {} doesn't match the current split, "
+                             "run `python prepare_data.py decode` again.".format(mode, decoded_folder))
+        self.columns = [self.attr2idx[attr_name] for attr_name in self.selected_attrs]
+
+    def __getitem__(self, index):
+        """Without transform, the image is a zero-copy [218, 178, 3] uint8 view of the shard."""
+        image = self.images[index]
+        if self.transform != None:
+            image = self.transform(Image.fromarray(image))
         else:
-            image = image.unsqueeze(0)
-            new_images = torch.cat([new_images, image], dim=0)
-            label = torch.tensor(label).unsqueeze(0)
-            new_labels = torch.cat([new_labels, label], dim=0)
-    new_batch['image'] = new_images
-    new_batch['label'] = new_labels
+            image = torch.from_numpy(image)
+        return image, torch.from_numpy(self.labels[index, self.columns].astype(np.int64))
+
+
+def _decode_rgb(image):
+    image = np.array(image.convert('RGB'))
+    if image.shape != (218, 178, 3):
+        raise ValueError("decode_images expects the aligned 218*178 images, got {}".format(image.shape))
+    return image
+
+
+def decode_images(image_dir, attr_path, decoded_dir, num_workers=1):
+    """
+    Decode the jpg files of every split once into <decoded_dir>/<mode>.images.npy,
+    a fixed shape N*218*178*3 uint8 array, with the int8 labels of all the
+    attributes in <mode>.labels.npy, in the same order as the split.
+    """
+    if not os.path.exists(decoded_dir):
+        os.makedirs(decoded_dir)
+    for mode in ["train", "validate", "test"]:
+        dataset = CelebA(attr_path, cfg.all_attrs, image_dir, _decode_rgb, mode)
+        loader = data.DataLoader(dataset=dataset, batch_size=256, num_workers=num_workers)
+        images_path = os.path.join(decoded_dir, mode + ".images.npy")
+        images = np.lib.format.open_memmap(images_path + ".tmp", mode='w+', dtype=np.uint8,
+                                           shape=(len(dataset), 218, 178, 3))
+        offset = 0
+        for batch, _ in loader:
+            images[offset:offset + len(batch)] = batch.numpy()
+            offset += len(batch)
+        images.flush()
+        del images
+        os.replace(images_path + ".tmp", images_path)
+        split = dataset.split_dataset()
+        np.save(os.path.join(decoded_dir, mode + ".labels.npy"), split.label_matrix())
+        np.save(os.path.join(decoded_dir, mode + ".filenames.npy"), split.filenames())
+        print("Decoded {} {} images into {}".format(len(dataset), mode, images_path))
+
+
+class CelebAShards(data.IterableDataset):
+    """
+    Stream a split sequentially from the tar shards written by write_shards, for
+    disks and object-store mounts where random access is slow. Each shard holds
+    <name>.jpg and <name>.cls (the int8 labels of all the attributes) pairs,
+    listed with their counts in <mode>.json.
+    In train mode the shard order is shuffled every epoch (set_epoch) and the
+    samples go through a shuffle buffer of shuffle_buffer images. The shards are
+    split across the ranks, then across the DataLoader workers of each rank.
+    The labels come from the shards, attr_file is only kept for the signature
+    of the other backends.
+    """
+    def __init__(self, attr_file, selected_attrs, shard_folder,
+                transform, mode = "train", decode_size = None,
+                shuffle_buffer = None, rank = 0, world_size = 1, seed = 1024):
+        with open(os.path.join(shard_folder, mode + ".json"), 'r') as f:
+            manifest = json.load(f)
+        self.shard_folder = shard_folder
+        self.shards = manifest["shards"]
+        self.columns = [manifest["attrs"].index(attr_name) for attr_name in selected_attrs]
+        self.transform = transform
+        self.mode = mode
+        self.decode_size = decode_size
+        self.shuffle = mode == "train"
+        self.shuffle_buffer = cfg.shuffle_buffer if shuffle_buffer == None else shuffle_buffer
+        self.rank = rank
+        self.world_size = world_size
+        self.seed = seed
+        # in shared memory: the persistent DataLoader workers keep their own copy of
+        # the dataset, they read the epoch of set_epoch from here.
+        self.shared_epoch = torch.zeros(1, dtype=torch.int64).share_memory_()
+
+    @property
+    def epoch(self):
+        return int(self.shared_epoch[0])
+
+    def set_epoch(self, epoch):
+        self.shared_epoch[0] = epoch
+
+    def __len__(self):
+        """The images of this rank, exact when the shards are the same size."""
+        return sum(shard["count"] for shard in self.rank_shards())
+
+    def rank_shards(self):
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[self.rank::self.world_size]
+
+    def __iter__(self):
+        shards = self.rank_shards()
+        worker_id = 0
+        worker = data.get_worker_info()
+        if worker is not None:
+            worker_id = worker.id
+            shards = shards[worker.id::worker.num_workers]
+        samples = self.read_shards(shards)
+        if self.shuffle:
+            rng = random.Random(hash((self.seed, self.epoch, self.rank, worker_id)))
+            samples = self.shuffled(samples, rng)
+        for image_bytes, label in samples:
+            yield self.process(image_bytes, label)
+
+    def read_shards(self, shards):
+        for shard in shards:
+            # "r|" reads the tar as a stream, without seeking.
+            with tarfile.open(os.path.join(self.shard_folder, shard["name"]), "r|") as tar:
+                image_bytes = None
+                for member in tar:
+                    content = tar.extractfile(member).read()
+                    if member.name.endswith(".jpg"):
+                        image_bytes = content
+                    else:
+                        yield image_bytes, np.frombuffer(content, dtype=np.int8)
+
+    def shuffled(self, samples, rng):
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            i = rng.randrange(len(buffer))
+            buffer[i], sample = sample, buffer[i]
+            yield sample
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
+    def process(self, image_bytes, label):
+        image = Image.open(io.BytesIO(image_bytes))
+        if self.decode_size != None:
+            image.draft('RGB', self.decode_size)
+        if self.transform != None:
+            image = self.transform(image)
+        return image, torch.from_numpy(label[self.columns].astype(np.int64))
+
+
+def write_shards(image_dir, attr_path, shard_dir, shard_size=5000):
+    """
+    Write every split, in the order of the split ranges of config.py, into tar
+    shards of shard_size images: <shard_dir>/<mode>-000000.tar, ... and the
+    <mode>.json manifest read by CelebAShards.
+    """
+    dataset = CelebA(attr_path, cfg.all_attrs, image_dir, None)
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    for mode, split in [("train", dataset.train_dataset),
+                        ("validate", dataset.validate_dataset),
+                        ("test", dataset.test_dataset)]:
+        shards = []
+        labels = split.label_matrix()
+        for start in range(0, len(split), shard_size):
+            name = "{}-{:06d}.tar".format(mode, len(shards))
+            path = os.path.join(shard_dir, name)
+            end = min(start + shard_size, len(split))
+            with tarfile.open(path + ".tmp", "w") as tar:
+                for i in range(start, end):
+                    filename = split.filename(i)
+                    key = os.path.splitext(filename)[0]
+                    with open(os.path.join(image_dir, filename), 'rb') as f:
+                        _add_tar_member(tar, key + ".jpg", f.read())
+                    _add_tar_member(tar, key + ".cls", labels[i].tobytes())
+            os.replace(path + ".tmp", path)
+            shards.append({"name": name, "count": end - start})
+        with open(os.path.join(shard_dir, mode + ".json"), 'w') as f:
+            json.dump({"attrs": list(cfg.all_attrs), "shards": shards}, f)
+        print("Wrote {} {} images into {} shards".format(len(split), mode, len(shards)))
+
+
+def _add_tar_member(tar, name, content):
+    info = tarfile.TarInfo(name)
+    info.size = len(content)
+    tar.addfile(info, io.BytesIO(content))
 
-    return new_batch
+
+DATA_BACKENDS = {"folder": CelebA, "packed": PackedCelebA, "decoded": DecodedCelebA,
+                 "stream": CelebAShards}
+
+
+_SPLIT_INDEX = {}
+
+def load_split_index(attr_file, selected_attrs):
+    """
+    Return (all_attr_names, [train, validate, test] SplitSamples). The split is
+    built once per process and shared by every CelebA dataset, and cached on
+    disk next to the attribute file, keyed by the hash of its content, the
+    selected attributes and the split ranges.
+    """
+    bounds = [0, cfg.train_end_index - 1, cfg.validate_end_index - 1, cfg.test_end_index - 1]
+    key = (os.path.abspath(attr_file), tuple(selected_attrs), tuple(bounds))
+    if key in _SPLIT_INDEX:
+        return _SPLIT_INDEX[key]
+
+    content_hash = hashlib.sha1()
+    with open(attr_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            content_hash.update(chunk)
+    content_hash.update(json.dumps([list(selected_attrs), bounds, 1024]).encode())
+    cache_path = "{}.split-{}.npz".format(attr_file, content_hash.hexdigest()[:16])
+
+    if os.path.exists(cache_path):
+        arrays = np.load(cache_path)
+        all_attr_names = arrays['all_attr_names'].tolist()
+        splits = [SplitSamples.from_arrays(*[arrays[mode + '_' + name] for name in
+                                             ['name_buffer', 'name_offsets', 'labels', 'num_attrs']])
+                  for mode in ['train', 'validate', 'test']]
+    else:
+        all_attr_names, splits = build_split_index(attr_file, selected_attrs, bounds)
+        arrays = {'all_attr_names': np.array(all_attr_names)}
+        for mode, split in zip(['train', 'validate', 'test'], splits):
+            for name, array in zip(['name_buffer', 'name_offsets', 'labels', 'num_attrs'], split.arrays()):
+                arrays[mode + '_' + name] = array
+        try:
+            # the ranks of torchrun build the same index at once, each writes its own temporary file.
+            write_atomic(lambda f: np.savez(f, **arrays), cache_path)
+        except OSError as e:
+            print("Could not save the split index: {}".format(e))
+
+    _SPLIT_INDEX[key] = (all_attr_names, splits)
+    return _SPLIT_INDEX[key]
+
+
+def build_split_index(attr_file, selected_attrs, bounds):
+    filenames, labels, all_attr_names = load_label_cache(attr_file)
+    attr2idx = {attr_name: i for i, attr_name in enumerate(all_attr_names)}
+
+    # shuffling the row indices draws the same permutation as shuffling the lines.
+    order = list(range(len(filenames)))
+    random.seed(1024)
+    random.shuffle(order)
+    order = np.asarray(order)
+
+    columns = [attr2idx[attr_name] for attr_name in selected_attrs]
+
+    # split the data by index.
+    splits = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        index = order[start:end]
+        splits.append(SplitSamples(filenames[index], labels[np.ix_(index, columns)]))
+    return all_attr_names, splits
+
+
+def label_cache_paths(attr_file):
+    """The label matrix, filename table and attribute names saved next to the attribute file."""
+    return attr_file + ".labels.npy", attr_file + ".filenames.npy", attr_file + ".attrs.npy"
+
+
+def build_label_cache(attr_file):
+    """
+    Convert list_attr_celeba.txt once into an int8 label matrix (-1 saved as 0)
+    and a filename table, so later runs can open them with mmap instead of parsing.
+    """
+    filenames, labels, all_attr_names = _parse_attr_file(attr_file)
+    for path, array in zip(label_cache_paths(attr_file),
+                           [labels, filenames, np.array(all_attr_names)]):
+        # write to a temporary file of this process first, a half written cache should never
+        # be loaded (the ranks of torchrun may build it at once).
+        write_atomic(lambda f: np.save(f, array), path)
+    print('Built the label cache of {}'.format(attr_file))
+    return filenames, labels, all_attr_names
+
+
+def load_label_cache(attr_file):
+    """
+    Return (filenames, labels, all_attr_names) of the attribute file. The arrays are
+    memory-mapped from the cache, which is (re)built when missing or older than the file.
+    """
+    paths = label_cache_paths(attr_file)
+    attr_mtime = os.path.getmtime(attr_file)
+    if not all(os.path.exists(path) and os.path.getmtime(path) >= attr_mtime for path in paths):
+        try:
+            return build_label_cache(attr_file)
+        except OSError as e:
+            # the dataset folder may be read only, parse without saving the cache.
+            print("Could not save the label cache: {}".format(e))
+            return _parse_attr_file(attr_file)
+    labels = np.load(paths[0], mmap_mode='r')
+    filenames = np.load(paths[1], mmap_mode='r')
+    all_attr_names = np.load(paths[2]).tolist()
+    return filenames, labels, all_attr_names
+
+
+def _parse_attr_file(attr_file):
+    with open(attr_file, 'r') as f:
+        lines = f.read().split('\n')
+    rows = [line.split() for line in lines[2:] if line.strip()]
+    labels = np.array([row[1:] for row in rows], dtype=np.int8)
+    labels[labels == -1] = 0
+    return np.array([row[0] for row in rows], dtype=np.bytes_), labels, lines[1].split()
+
+
+class FastCollate(object):
+    """
+    Collate [(image, label)] into one preallocated image tensor and one
+    [batch_size, num_attr] label tensor, written in place sample by sample.
+    In the worker processes the buffers are allocated in shared memory, so
+    they are handed to the main process without another copy. With pin_memory
+    the buffers of the main process are page-locked; in the workers that is
+    left to the pin_memory thread of the DataLoader.
+    """
+    def __init__(self, pin_memory=False):
+        self.pin_memory = pin_memory
+
+    def __call__(self, batch):
+        image, label = batch[0]
+        in_worker = data.get_worker_info() is not None
+        images = self.empty_batch((len(batch),) + tuple(image.shape), image.dtype, in_worker)
+        labels = self.empty_batch((len(batch),) + tuple(label.shape), label.dtype, in_worker)
+        for i, (image, label) in enumerate(batch):
+            images[i].copy_(image)
+            labels[i].copy_(label)
+        return images, labels
+
+    def empty_batch(self, shape, dtype, in_worker):
+        tensor = torch.empty(0, dtype=dtype)
+        if in_worker:
+            # allocate straight in shared memory like default_collate, share_memory_() would copy.
+            numel = int(np.prod(shape))
+            if hasattr(torch, "UntypedStorage"):
+                storage = torch.UntypedStorage._new_shared(numel * tensor.element_size())
+            else:
+                storage = tensor.storage()._new_shared(numel)
+            return tensor.set_(storage).view(shape)
+        tensor = tensor.new_empty(shape)
+        if self.pin_memory and torch.cuda.is_available():
+            tensor = tensor.pin_memory()
+        return tensor
+
+
+collate_fn = FastCollate()
+
+class ResumableSampler(data.Sampler):
+    """
+    A random permutation of the dataset per epoch, drawn from seed and epoch
+    only, that can start at any position of the epoch. A resumed run sees the
+    same data order from where it stopped.
+    """
+    def __init__(self, data_source, seed=None):
+        self.data_source = data_source
+        self.seed = torch.initial_seed() if seed == None else seed
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start: the number of samples of the epoch already seen."""
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        return iter(order[self.start:].tolist())
+
+    def __len__(self):
+        return len(self.data_source) - self.start
+
+class DistributedResumableSampler(data.DistributedSampler):
+    """
+    The ResumableSampler of a rank of DistributedDataParallel: every rank takes
+    its part of the same per epoch permutation, from its start-th sample. With a
+    single rank it gives the order of ResumableSampler.
+    """
+    def __init__(self, data_source, num_replicas, rank, seed=None):
+        seed = torch.initial_seed() if seed == None else seed
+        super(DistributedResumableSampler, self).__init__(data_source, num_replicas, rank,
+                                                          shuffle=True, seed=seed, drop_last=True)
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        """start: the number of samples of the epoch this rank has already seen."""
+        super(DistributedResumableSampler, self).set_epoch(epoch)
+        self.start = start
+
+    def __iter__(self):
+        return itertools.islice(super(DistributedResumableSampler, self).__iter__(), self.start, None)
+
+    def __len__(self):
+        return self.num_samples - self.start
 
 # 218 * 178
 def get_loader(image_dir, attr_path, selected_attrs,
-               batch_size, mode='train', num_workers=1, transform = None):
-    """Build and return a data loader."""
-    dataset = CelebA(attr_path, selected_attrs, image_dir,transform, mode)
+               batch_size, mode='train', num_workers=1, transform = None, backend = "folder",
+               pin_memory = False, prefetch_factor = 2, persistent_workers = False, decode_size = None,
+               rank = 0, world_size = 1):
+    """
+    Build and return a data loader.
+    backend: "folder" reads the jpg files in image_dir, "packed" reads the
+    containers of pack_images, "decoded" the uint8 shards of decode_images and
+    "stream" the tar shards of write_shards sequentially, then image_dir is the
+    folder of the containers or shards.
+    rank, world_size: the process of DistributedDataParallel, see create_loader.
+    """
+    dataset = DATA_BACKENDS[backend](attr_path, selected_attrs, image_dir, transform, mode, decode_size)
+    # the evaluation keeps the last partial batch, every image is scored. (every worker of a
+    # streamed dataset batches its own shards, drop_last would drop a partial batch per worker.)
+    return create_loader(dataset, batch_size, mode == 'train', num_workers,
+                         pin_memory, prefetch_factor, persistent_workers, rank, world_size, mode == 'train')
+
+def create_loader(dataset, batch_size, shuffle, num_workers=1, pin_memory=False,
+                  prefetch_factor=2, persistent_workers=False, rank=0, world_size=1, drop_last=True):
+    """
+    Wrap a dataset into a data loader, the worker settings only apply with num_workers > 0.
+    The shuffled map-style datasets use a ResumableSampler. With world_size > 1 the loader
+    only yields the part of rank: the shuffled map-style datasets use a
+    DistributedResumableSampler and the streamed shards are split by file.
+    """
+    worker_kwargs = {}
+    if num_workers > 0:
+        worker_kwargs['prefetch_factor'] = prefetch_factor # batches loaded in advance by each worker
+        worker_kwargs['persistent_workers'] = persistent_workers # keep the workers between epochs
+    sampler = None
+    if isinstance(dataset, data.IterableDataset):
+        # a streamed dataset shuffles itself.
+        if world_size > 1:
+            dataset.rank, dataset.world_size = rank, world_size
+    elif shuffle and world_size > 1:
+        sampler = DistributedResumableSampler(dataset, world_size, rank)
+    elif shuffle:
+        sampler = ResumableSampler(dataset)
+    # the seeds of the workers come from their own generator instead of the global random state,
+    # so that a resumed run continues with the same random state.
+    generator = torch.Generator()
+    generator.manual_seed(torch.initial_seed())
     data_loader = data.DataLoader(dataset=dataset,
                                   batch_size=batch_size,
-                                  shuffle=(mode=='train'),
+                                  sampler=sampler,
+                                  generator=generator,
                                   num_workers=num_workers,
-                                  drop_last = True) # drop_last：告诉如何处理数据集长度除于batch_size余下的数据。True就抛弃，否则保留
+                                  collate_fn=FastCollate(pin_memory and num_workers == 0),
+                                  pin_memory=pin_memory and num_workers > 0,
+                                  drop_last = drop_last, # drop_last：告诉如何处理数据集长度除于batch_size余下的数据。True就抛弃，否则保留
+                                  **worker_kwargs)
     return data_loader
 
+def autotune_loader(dataset, batch_size, pin_memory=False, num_batches=10):
     """
-    data_loader:
-    {
-        'image': [batch_size, C, H, W],
-        'label': [batch_size, num_attr]
-    }
+    Measure the images/s of a few worker settings on the first batches of the
+    dataset and return the fastest (num_workers, prefetch_factor). The worker
+    counts are searched first, then the prefetch depth of the best one.
     """
-    
+    cpu_count = os.cpu_count() or 1
+    worker_counts = sorted(set([n for n in [1, 2, 4, 8, 16, 32, 64] if n < cpu_count] + [cpu_count]))
+
+    def images_per_second(num_workers, prefetch_factor):
+        data_loader = create_loader(dataset, batch_size, True, num_workers, pin_memory, prefetch_factor)
+        loader_start = start_time = time.time()
+        idx = -1
+        batches = iter(data_loader)
+        try:
+            for idx, _ in enumerate(batches):
+                if idx == 0:
+                    start_time = time.time() # not counting the start of the workers
+                if idx == num_batches:
+                    break
+        finally:
+            # stop the workers and drop their prefetched batches before the next trial.
+            if hasattr(batches, "_shutdown_workers"):
+                batches._shutdown_workers()
+            del batches
+        timed = idx
+        if idx <= 0:
+            # an empty or single batch loader, the first batch is timed with the start of the workers.
+            timed, start_time = idx + 1, loader_start
+        speed = timed * batch_size / max(time.time() - start_time, 1e-9)
+        print("num_workers: {}, prefetch_factor: {}, {:.1f} images/s".format(num_workers, prefetch_factor, speed))
+        return speed
+
+    best_workers = max(worker_counts, key=lambda n: images_per_second(n, 2))
+    best_prefetch = max([2, 4, 8], key=lambda p: images_per_second(best_workers, p))
+    print("The fastest loader setting: num_workers {}, prefetch_factor {}".format(best_workers, best_prefetch))
+    return best_workers, best_prefetch
+
 def test():
     transform = []
     transform.append(transforms.Resize(size=(224, 224)))
@@ -208,7 +761,6 @@ def test():
     for idx, data in enumerate(data_loader):
         image, label = data
         print(image)
-        label = torch.stack(label).t()
         print(image.size())
         print(label.size())
         exit()
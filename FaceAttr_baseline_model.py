@@ -82,11 +82,17 @@ class FeatureClassfier(nn.Module):
 
 
     def forward(self, x):
-        x = x.view(x.size(0), -1)  # flatten
-        res = self.fc(x)
-        res = self.sigmoid(res)
+        res = self.logits(x)
+        # the sigmoid in fp32: under autocast the bf16/fp16 probabilities near the
+        # thresholds would be rounded to a few bits, which ties the ranks of the scores.
+        res = self.sigmoid(res.float())
         return res
 
+    def logits(self, x):
+        """The scores before the sigmoid, the losses are computed from them."""
+        x = x.reshape(x.size(0), -1)  # flatten
+        return self.fc(x)
+
 
 """
 conbime the extraction and classfier
@@ -106,6 +112,10 @@ class FaceAttrModel(nn.Module):
         results = self.featureClassfier(features)
         return results
 
+    def logits(self, image):
+        features = self.featureExtractor(image)
+        return self.featureClassfier.logits(features)
+
 
 
 
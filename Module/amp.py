@@ -0,0 +1,22 @@
+import contextlib
+import torch
+
+
+def amp_dtype(device_type):
+    """bf16 on the cpu, fp16 on cuda."""
+    return torch.float16 if device_type == "cuda" else torch.bfloat16
+
+
+def autocast(device_type, enabled=True):
+    """The mixed precision context of the forward passes, nothing when not enabled."""
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device_type, dtype=amp_dtype(device_type))
+
+
+def grad_scaler(device_type, enabled=True):
+    """The loss scaling of the fp16 gradients on cuda, bf16 keeps the fp32 exponent range and needs none."""
+    enabled = enabled and device_type == "cuda"
+    if hasattr(torch, "amp") and hasattr(torch.amp, "GradScaler"):
+        return torch.amp.GradScaler("cuda", enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
@@ -0,0 +1,65 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+class ToUint8Tensor(object):
+    """Turn a PIL image into a [3, H, W] uint8 tensor, the only work left to the loader workers."""
+    def __call__(self, image):
+        image = np.array(image.convert('RGB'), dtype=np.uint8)
+        return torch.from_numpy(image).permute(2, 0, 1)
+
+
+class BatchAugmentation(object):
+    """
+    The transforms of Solver.set_transform applied on a whole uint8 batch after
+    collation. In train mode every image gets its own random horizontal flip and
+    rotation, which are folded with the resize into one affine grid sampled for
+    the batch at once. Then the batch is scaled to [0, 1], optionally distorted
+    by color_jitter (e.g. data_augmentation.BatchPhotometricDistort) and normalized.
+    The batch may be [B, 3, H, W] or channels last [B, H, W, 3] (the decoded shards).
+    """
+    def __init__(self, train, size=(224, 224), degrees=30, flip_prob=0.5,
+                 mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5), color_jitter=None):
+        self.train = train
+        self.color_jitter = color_jitter
+        self.size = size
+        self.degrees = degrees
+        self.flip_prob = flip_prob
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def __call__(self, images):
+        if images.size(-1) == 3 and images.size(1) != 3:
+            images = images.permute(0, 3, 1, 2)
+        images = images.float().div_(255)
+        if self.train:
+            images = F.grid_sample(images, self.affine_grid(images), mode='bilinear',
+                                   padding_mode='zeros', align_corners=False)
+        else:
+            images = F.interpolate(images, size=self.size, mode='bilinear', align_corners=False)
+        if self.train and self.color_jitter is not None:
+            images = self.color_jitter(images)
+        mean = self.mean.to(images.device)
+        std = self.std.to(images.device)
+        return images.sub_(mean).div_(std)
+
+    def affine_grid(self, images):
+        """
+        Map every output pixel to the input pixel it samples from. The rotation is
+        done in pixel units around the center, the normalized coordinates of the
+        non square image are scaled by its aspect ratio around it.
+        """
+        batch_size, _, height, width = images.size()
+        device = images.device
+        angle = (torch.rand(batch_size, device=device) * 2 - 1) * self.degrees * math.pi / 180
+        flip = torch.ones(batch_size, device=device)
+        flip[torch.rand(batch_size, device=device) < self.flip_prob] = -1
+        cos, sin = torch.cos(angle), torch.sin(angle)
+        zero = torch.zeros(batch_size, device=device)
+        theta = torch.stack([
+            torch.stack([cos * flip, -sin * height / width, zero], dim=1),
+            torch.stack([sin * flip * width / height, cos, zero], dim=1),
+        ], dim=1)
+        return F.affine_grid(theta, [batch_size, 3, self.size[0], self.size[1]], align_corners=False)
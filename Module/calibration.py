@@ -0,0 +1,70 @@
+import json
+import numpy as np
+
+
+def sweep_thresholds(scores, labels):
+    """
+    The confusion counts of every attribute at every cut of its sorted scores,
+    from one argsort and cumulative sums instead of a loop over thresholds.
+    scores, labels: [num_images, num_attr]
+    Return TP, FP, FN, TN and the thresholds, all [num_images + 1, num_attr]:
+    row k predicts the k highest scores of a column as positive, i.e. score > threshold.
+    Rows that would split tied scores are marked invalid with a nan threshold.
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    labels = np.asarray(labels) == 1
+    num_images, num_attr = scores.shape
+    order = np.argsort(-scores, axis=0, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    sorted_labels = np.take_along_axis(labels, order, axis=0)
+
+    zeros = np.zeros((1, num_attr), dtype=np.int64)
+    TP = np.concatenate([zeros, np.cumsum(sorted_labels, axis=0)])
+    FP = np.arange(num_images + 1)[:, None] - TP
+    positives = TP[-1]
+    FN = positives - TP
+    TN = (num_images - positives) - FP
+
+    # the threshold of row k lies between the k-th and the (k+1)-th highest scores.
+    upper = np.concatenate([np.full((1, num_attr), np.inf, dtype=np.float32), sorted_scores])
+    lower = np.concatenate([sorted_scores, np.full((1, num_attr), -np.inf, dtype=np.float32)])
+    with np.errstate(invalid='ignore', over='ignore'):
+        thresholds = (lower.astype(np.float64) + (upper.astype(np.float64) - lower) / 2).astype(np.float32)
+    # keep score > threshold exact after the float32 rounding.
+    thresholds = np.where(thresholds >= upper, lower, thresholds)
+    thresholds[0] = np.maximum(sorted_scores[0], 1.0)
+    thresholds[-1] = np.minimum(np.nextafter(sorted_scores[-1], np.float32(-np.inf)), 0.0)
+    thresholds[upper == lower] = np.nan
+    return TP, FP, FN, TN, thresholds
+
+
+def calibrate_thresholds(scores, labels, metric="F1"):
+    """
+    Choose the threshold of every attribute that maximizes the F1 or the
+    accuracy on the (validate) scores, every distinct score being a candidate.
+    Return (thresholds, best metric values), both [num_attr].
+    """
+    assert metric in ["F1", "accuracy"]
+    TP, FP, FN, TN, thresholds = sweep_thresholds(scores, labels)
+    if metric == "F1":
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values = np.nan_to_num(2 * TP / (2 * TP + FP + FN))
+    else:
+        values = (TP + TN) / (TP.shape[0] - 1)
+    values = np.where(np.isnan(thresholds), -np.inf, values)
+    best = np.argmax(values, axis=0)
+    columns = np.arange(values.shape[1])
+    return thresholds[best, columns], values[best, columns]
+
+
+def save_thresholds(path, attr_names, thresholds, metric):
+    with open(path, "w") as f:
+        json.dump({"metric": metric,
+                   "thresholds": {attr: float(t) for attr, t in zip(attr_names, thresholds)}}, f, indent=2)
+
+
+def load_thresholds(path, attr_names, default):
+    """The thresholds of attr_names from a calibration file, default[i] for the missing ones."""
+    with open(path) as f:
+        thresholds = json.load(f)["thresholds"]
+    return [thresholds.get(attr, default[i]) for i, attr in enumerate(attr_names)]
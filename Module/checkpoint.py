@@ -0,0 +1,142 @@
+import copy
+import os
+import random
+import tempfile
+import threading
+import numpy as np
+import torch
+
+
+def snapshot(obj):
+    """A copy of obj where every tensor is cloned to the cpu, so the training can go on."""
+    if torch.is_tensor(obj):
+        return obj.detach().cpu().clone()
+    if isinstance(obj, dict):
+        # a shallow copy keeps the type and its state (Counter, defaultdict, OrderedDict),
+        # rebuilding it from the (key, value) pairs would count them into a Counter.
+        copied = copy.copy(obj)
+        for k, v in obj.items():
+            copied[k] = snapshot(v)
+        return copied
+    if isinstance(obj, tuple) and hasattr(obj, "_fields"):  # namedtuple
+        return type(obj)(*(snapshot(v) for v in obj))
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(v) for v in obj)
+    return obj
+
+
+def states_equal(x, y):
+    """Whether two states (nested dicts, lists and tuples of tensors and values) are the same, types included."""
+    if torch.is_tensor(x) or torch.is_tensor(y):
+        return (torch.is_tensor(x) and torch.is_tensor(y) and x.dtype == y.dtype
+                and x.shape == y.shape and torch.equal(x.cpu(), y.cpu()))
+    if type(x) != type(y):
+        return False
+    if isinstance(x, dict):
+        return x.keys() == y.keys() and all(states_equal(x[k], y[k]) for k in x)
+    if isinstance(x, (list, tuple)):
+        return len(x) == len(y) and all(states_equal(a, b) for a, b in zip(x, y))
+    if isinstance(x, np.ndarray):
+        return x.dtype == y.dtype and np.array_equal(x, y)
+    return x == y
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+def write_atomic(write, path):
+    """
+    Call write(f) on a temporary file of this process and rename it to path, a crash
+    never leaves a half written file and the processes writing the same path at once
+    (the ranks, the eval workers) do not write into each other's file: the last
+    rename wins.
+    """
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(path) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_atomic(state, path):
+    """Write to a temporary file and rename it, a crash never leaves a half written checkpoint."""
+    write_atomic(lambda f: torch.save(state, f), path)
+
+
+def load_checkpoint(path):
+    try:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location="cpu")
+
+
+class AsyncCheckpointer(object):
+    """
+    Write the checkpoints with save_atomic in a background thread. save() only
+    copies the state to the cpu; a newer state of the same path replaces the
+    one still waiting to be written. wait() blocks until everything is on disk,
+    the errors of the thread are raised by the next save or wait.
+    """
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.jobs = {}  # path: state waiting to be written
+        self.busy = False
+        self.error = None
+        self.thread = None
+
+    def save(self, state, path):
+        state = snapshot(state)
+        with self.condition:
+            self.raise_error()
+            if self.thread == None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.jobs[path] = state
+            self.condition.notify_all()
+
+    def wait(self):
+        with self.condition:
+            while self.jobs or self.busy:
+                self.condition.wait()
+            self.raise_error()
+
+    def raise_error(self):
+        if self.error != None:
+            error, self.error = self.error, None
+            raise error
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.jobs:
+                    self.condition.wait()
+                path = next(iter(self.jobs))
+                state = self.jobs.pop(path)
+                self.busy = True
+            try:
+                save_atomic(state, path)
+            except Exception as e:
+                self.error = e
+            with self.condition:
+                self.busy = False
+                self.condition.notify_all()
@@ -0,0 +1,77 @@
+import os
+import torch
+from Module.checkpoint import write_atomic
+
+# eager: the nn.Module, compile: torch.compile (inductor) for training and evaluation,
+# torchscript: a traced, frozen and optimized graph for the evaluation (inference only).
+GRAPH_MODES = ["eager", "compile", "torchscript"]
+
+
+def artifact_path(cache_dir, model_type, num_attrs, shape, device_type="cpu", channels_last=False, amp=False,
+                  extension=".pt"):
+    """
+    The cached graph of model_type with a head of num_attrs outputs for inputs of shape,
+    e.g. Resnet50-40attrs-cpu-128x3x224x224-nhwc-amp.pt
+    """
+    name = "{}-{}attrs-{}-{}-{}".format(model_type, num_attrs, device_type, "x".join(str(s) for s in shape),
+                                        "nhwc" if channels_last else "nchw")
+    if amp:
+        name += "-amp"
+    return os.path.join(cache_dir, name + extension)
+
+
+def set_compile_cache(cache_dir):
+    """Keep the inductor caches (compiled kernels, FX and AOTAutograd graphs) in cache_dir."""
+    os.environ["TORCHINDUCTOR_CACHE_DIR"] = os.path.abspath(os.path.join(cache_dir, "inductor"))
+
+
+def load_compiled(cache_path):
+    """
+    Load the torch.compile artifacts an earlier process saved to cache_path, the
+    inductor caches then hit instead of compiling the same graphs again.
+    """
+    if not os.path.exists(cache_path) or not hasattr(torch.compiler, "load_cache_artifacts"):
+        return False
+    with open(cache_path, "rb") as f:
+        torch.compiler.load_cache_artifacts(f.read())
+    print("The compiled graphs {} have loaded!".format(cache_path))
+    return True
+
+
+def save_compiled(cache_path):
+    """Save the torch.compile artifacts of the graphs compiled so far by this process."""
+    if not hasattr(torch.compiler, "save_cache_artifacts"):  # torch < 2.7, only the inductor caches
+        return False
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts == None:
+        return False
+    write_atomic(lambda f: f.write(artifacts[0]), cache_path)
+    return True
+
+
+def trace_model(model, example, cache_path):
+    """
+    The TorchScript graph of model in eval mode traced on example, loaded from cache_path
+    when an earlier process traced it. It keeps its own parameters, see freeze_model.
+    """
+    if os.path.exists(cache_path):
+        print("The traced graph {} has loaded!".format(cache_path))
+        return torch.jit.load(cache_path, map_location=example.device)
+    training = model.training
+    model.eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    model.train(training)
+    write_atomic(lambda f: torch.jit.save(traced, f), cache_path)
+    return traced
+
+
+def freeze_model(traced, state_dict):
+    """
+    Load state_dict into the traced graph, then inline the weights as constants (freeze)
+    and fold the batch norms and fuse the ops (optimize_for_inference).
+    """
+    traced.load_state_dict(state_dict)
+    traced.eval()
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
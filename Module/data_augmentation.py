@@ -1,4 +1,5 @@
 from numpy import random
+import torch
 
 
 """The code is from yolact's data augmentations."""
@@ -51,6 +52,7 @@ class ConvertColor(object):
         self.current = current
 
     def __call__(self, image):
+        import cv2  # here, solver.py imports this module for the batched kernels, which need no OpenCV
         if self.current == 'BGR' and self.transform == 'HSV':
             image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
         elif self.current == 'HSV' and self.transform == 'BGR':
@@ -85,4 +87,112 @@ class RandomBrightness(object):
         if random.randint(2):
             delta = random.uniform(-self.delta, self.delta)
             image += delta
-        return image
\ No newline at end of file
+        return image
+
+
+"""
+The batched versions: every kernel takes a [B, 3, H, W] float RGB batch in [0, 1]
+and draws its random parameters per image, all images in a few tensor operations.
+"""
+def rgb_to_hsv(images, eps=1e-8):
+    """[B, 3, H, W] RGB in [0, 1] -> HSV with hue in degrees [0, 360), like cv2 on float images."""
+    r, g, b = images.unbind(1)
+    maxc, _ = images.max(1)
+    minc, _ = images.min(1)
+    delta = maxc - minc
+    saturation = delta / (maxc + eps)
+    rc = (maxc - r) / (delta + eps)
+    gc = (maxc - g) / (delta + eps)
+    bc = (maxc - b) / (delta + eps)
+    hue = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    hue = torch.where(delta > 0, (hue * 60.0) % 360.0, torch.zeros_like(hue))
+    return torch.stack([hue, saturation, maxc], dim=1)
+
+
+def hsv_to_rgb(images):
+    """The inverse of rgb_to_hsv."""
+    hue, saturation, value = images.unbind(1)
+    sector = hue / 60.0
+    i = torch.floor(sector)
+    f = sector - i
+    i = (i.long() % 6).unsqueeze(1)
+    p = value * (1 - saturation)
+    q = value * (1 - saturation * f)
+    t = value * (1 - saturation * (1 - f))
+    # the (r, g, b) of the 6 hue sectors, picked per pixel.
+    r = torch.stack([value, q, p, p, t, value], dim=1).gather(1, i)
+    g = torch.stack([t, value, value, q, p, p], dim=1).gather(1, i)
+    b = torch.stack([p, p, t, value, value, q], dim=1).gather(1, i)
+    return torch.cat([r, g, b], dim=1)
+
+
+def _random_factor(images, lower, upper, default):
+    """One factor per image, drawn in [lower, upper) for half of the images and default for the others."""
+    batch_size = images.size(0)
+    factor = torch.empty(batch_size, device=images.device).uniform_(lower, upper)
+    keep = torch.rand(batch_size, device=images.device) < 0.5
+    factor[keep] = default
+    return factor.view(batch_size, 1, 1, 1)
+
+
+class BatchRandomSaturation(object):
+    """Scale the saturation of an HSV batch."""
+    def __init__(self, lower=0.5, upper=1.5):
+        assert upper >= lower, "saturation upper must be >= lower."
+        assert lower >= 0, "saturation lower must be non-negative."
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images):
+        factor = _random_factor(images, self.lower, self.upper, 1.0)
+        images[:, 1:2] = (images[:, 1:2] * factor).clamp_(0, 1)
+        return images
+
+
+class BatchRandomHue(object):
+    """Shift the hue of an HSV batch by up to delta degrees."""
+    def __init__(self, delta=18.0):
+        assert delta >= 0.0 and delta <= 360.0
+        self.delta = delta
+
+    def __call__(self, images):
+        shift = _random_factor(images, -self.delta, self.delta, 0.0)
+        images[:, 0:1] = (images[:, 0:1] + shift) % 360.0
+        return images
+
+
+class BatchRandomContrast(object):
+    def __init__(self, lower=0.5, upper=1.5):
+        assert upper >= lower, "contrast upper must be >= lower."
+        assert lower >= 0, "contrast lower must be non-negative."
+        self.lower = lower
+        self.upper = upper
+
+    def __call__(self, images):
+        return images * _random_factor(images, self.lower, self.upper, 1.0)
+
+
+class BatchRandomBrightness(object):
+    """delta is on the 0-255 scale of the per image version."""
+    def __init__(self, delta=32):
+        assert delta >= 0.0
+        assert delta <= 255.0
+        self.delta = delta
+
+    def __call__(self, images):
+        return images + _random_factor(images, -self.delta / 255.0, self.delta / 255.0, 0.0)
+
+
+class BatchPhotometricDistort(object):
+    """Brightness and contrast in RGB, saturation and hue in HSV, then clip back to [0, 1]."""
+    def __init__(self):
+        self.rgb_distort = [BatchRandomBrightness(), BatchRandomContrast()]
+        self.hsv_distort = [BatchRandomSaturation(), BatchRandomHue()]
+
+    def __call__(self, images):
+        for distort in self.rgb_distort:
+            images = distort(images)
+        images = rgb_to_hsv(images.clamp(0, 1))
+        for distort in self.hsv_distort:
+            images = distort(images)
+        return hsv_to_rgb(images).clamp_(0, 1)
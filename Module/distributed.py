@@ -0,0 +1,80 @@
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def init_distributed(backend="gloo"):
+    """
+    Join the process group of torchrun (it sets RANK, WORLD_SIZE and LOCAL_RANK), e.g.
+        torchrun --nproc_per_node 8 main.py --distributed ...
+    Return the rank and the world size.
+    """
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+    print("Rank {} of {} has joined the {} process group".format(get_rank(), get_world_size(), backend))
+    return get_rank(), get_world_size()
+
+
+def get_rank():
+    return dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get("LOCAL_RANK", 0))
+
+
+def is_main_process():
+    """Only the rank 0 writes the checkpoints, models and results."""
+    return get_rank() == 0
+
+
+def cleanup_distributed():
+    if dist.is_available() and dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if dist.is_available() and dist.is_initialized():
+        dist.barrier()
+
+
+def all_reduce_sum(value):
+    """The sum over the ranks of a number."""
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor)
+    return tensor.item()
+
+
+def all_reduce_metrics(metrics):
+    """Sum the confusion counts and the samples of a MultiLabelMetrics over the ranks."""
+    counts = metrics.counts.cpu()  # gloo reduces cpu tensors
+    num_samples = torch.tensor([metrics.num_samples])
+    dist.all_reduce(counts)
+    dist.all_reduce(num_samples)
+    metrics.load_state_dict({"counts": counts, "num_samples": int(num_samples.item())})
+    return metrics
+
+
+def gather_batches(batches):
+    """The batches of every rank, in rank order, on the cpu."""
+    parts = [None] * get_world_size()
+    dist.all_gather_object(parts, [batch.cpu() for batch in batches])
+    return [batch for part in parts for batch in part]
+
+
+class Logits(nn.Module):
+    """
+    The logits of a FaceAttrModel (or of its FeatureClassfier) as the forward,
+    DistributedDataParallel only synchronizes the gradients of the passes through its forward.
+    """
+    def __init__(self, model):
+        super(Logits, self).__init__()
+        self.model = model
+
+    def forward(self, images):
+        return self.model.logits(images)
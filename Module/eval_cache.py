@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import torch
+
+
+class EvalCache(object):
+    """
+    Keep the preprocessed images of the validate or test split after the first
+    evaluation, as their transforms are deterministic. The first iteration
+    streams the batches of data_loader through preprocess and stores them, the
+    next ones yield the (images, labels) batches straight from the cache.
+
+    dtype: "uint8" quantizes the normalized images back to their 0-255 pixels,
+    which is lossless after Resize + ToTensor, "float16" keeps them as they are.
+    The outputs of preprocess (e.g. the bilinear resize of batch_augment) are no
+    longer integer pixels, so they are always kept in float16.
+    The cache stays in RAM if it fits in memory_budget bytes, else it goes to a
+    memmap file in cache_dir. If that fails too, every evaluation streams.
+    """
+    def __init__(self, data_loader, name, dtype="uint8", preprocess=None,
+                 memory_budget=8 * 2**30, cache_dir="./result/eval_cache/",
+                 mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)):
+        assert dtype in ["uint8", "float16"]
+        if dtype == "uint8" and preprocess is not None:
+            print("The preprocessed images of {} are not integer pixels, they are cached in float16.".format(name))
+            dtype = "float16"
+        self.data_loader = data_loader
+        self.dataset = data_loader.dataset
+        self.batch_size = data_loader.batch_size
+        self.name = name
+        self.dtype = dtype
+        self.preprocess = preprocess
+        self.memory_budget = memory_budget
+        self.cache_dir = cache_dir
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+        self.images = None
+        self.labels = None
+        self.built = False
+        self.streaming = False
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __iter__(self):
+        if self.built:
+            return self.read()
+        return self.build()
+
+    def read(self):
+        for start in range(0, len(self.labels), self.batch_size):
+            end = start + self.batch_size
+            images = self.images[start:end]
+            if not torch.is_tensor(images):
+                images = torch.from_numpy(np.ascontiguousarray(images))
+            if self.dtype == "uint8":
+                images = images.float().div_(255).sub_(self.mean).div_(self.std)
+            else:
+                images = images.float()
+            yield images, self.labels[start:end]
+
+    def build(self):
+        num_images = len(self.dataset)
+        if self.data_loader.drop_last:
+            num_images = len(self.data_loader) * self.batch_size  # the loader drops the last batch
+        offset = 0
+        for images, labels in self.data_loader:
+            if self.preprocess is not None:
+                images = self.preprocess(images)
+            if self.images is None and not self.streaming:
+                self.allocate(num_images, images.shape[1:], labels.shape[1:])
+            if not self.streaming:
+                self.store(offset, images.detach().cpu(), labels)
+                offset += len(labels)
+            yield images, labels
+        if not self.streaming and offset == num_images:
+            if isinstance(self.images, np.memmap):
+                self.images.flush()
+            self.built = True
+            print("Cached the {} {} images of {}".format(offset, self.dtype, self.name))
+
+    def allocate(self, num_images, image_shape, label_shape):
+        shape = (num_images,) + tuple(image_shape)
+        itemsize = 1 if self.dtype == "uint8" else 2
+        self.labels = torch.empty((num_images,) + tuple(label_shape), dtype=torch.int64)
+        if num_images * int(np.prod(image_shape)) * itemsize <= self.memory_budget:
+            torch_dtype = torch.uint8 if self.dtype == "uint8" else torch.float16
+            self.images = torch.empty(shape, dtype=torch_dtype)
+            return
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            path = os.path.join(self.cache_dir, "{}-{}.npy".format(self.name, self.dtype))
+            self.images = np.lib.format.open_memmap(path, mode='w+', dtype=self.dtype, shape=shape)
+        except OSError as e:
+            print("Could not create the eval cache of {}, keep streaming: {}".format(self.name, e))
+            self.images = None
+            self.labels = None
+            self.streaming = True
+
+    def store(self, offset, images, labels):
+        if self.dtype == "uint8":
+            images = (images * self.std + self.mean).mul_(255).round_().clamp_(0, 255).to(torch.uint8)
+        else:
+            images = images.half()
+        if torch.is_tensor(self.images):
+            self.images[offset:offset + len(images)] = images
+        else:
+            self.images[offset:offset + len(images)] = images.numpy()
+        self.labels[offset:offset + len(labels)] = labels
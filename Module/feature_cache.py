@@ -0,0 +1,90 @@
+import hashlib
+import os
+import time
+import numpy as np
+import torch
+from torch.utils import data
+
+
+def weights_digest(module):
+    """A short digest of the weights of module, the cached features belong to these weights."""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()[:12]
+
+
+def feature_path(cache_dir, model_type, mode, input_size, digest):
+    """e.g. Resnet101-train-224-3f2a9c0d1b7e.features.npy"""
+    return os.path.join(cache_dir, "{}-{}-{}-{}.features.npy".format(model_type, mode, input_size, digest))
+
+
+def extract_features(forward, data_loader, path, num_images):
+    """
+    Run forward (the images of a batch to their features) once over every image of
+    data_loader, in order, and write the flattened features in fp16 to the .npy file
+    at path. The file is written under a temporary name and renamed when complete.
+    """
+    if not os.path.exists(os.path.dirname(path) or "."):
+        os.makedirs(os.path.dirname(path))
+    tmp_path = path + ".tmp"
+    features = None
+    offset = 0
+    start_time = time.time()
+    with torch.no_grad():
+        for batch_idx, (images, labels) in enumerate(data_loader):
+            outputs = forward(images)
+            outputs = outputs.reshape(outputs.size(0), -1).float().cpu().numpy()
+            if features is None:
+                features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                                     shape=(num_images, outputs.shape[1]))
+            features[offset:offset + len(outputs)] = outputs
+            offset += len(outputs)
+            if batch_idx % 50 == 0:
+                print("Extracting the features: {}/{} images, {:.1f} s".format(offset, num_images,
+                                                                               time.time() - start_time))
+    assert offset == num_images, "the loader must yield every image, without drop_last"
+    features.flush()
+    del features
+    os.replace(tmp_path, path)
+    print("The {} features are saved in {}".format(num_images, path))
+
+
+def merge_features(part_paths, path):
+    """
+    Concatenate the feature files of part_paths (e.g. extracted by every rank), in
+    order, into the .npy file at path, then remove the parts.
+    """
+    parts = [load_features(part_path) for part_path in part_paths]
+    tmp_path = path + ".tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16,
+                                         shape=(sum(len(part) for part in parts), parts[0].shape[1]))
+    offset = 0
+    for part in parts:
+        features[offset:offset + len(part)] = part
+        offset += len(part)
+    features.flush()
+    del features, parts
+    os.replace(tmp_path, path)
+    for part_path in part_paths:
+        os.remove(part_path)
+
+
+def load_features(path):
+    return np.load(path, mmap_mode='r')
+
+
+class FeatureDataset(data.Dataset):
+    """(feature, label) samples of the cached features, read from the fp16 memmap and given in fp32."""
+    def __init__(self, features, labels):
+        assert len(features) == len(labels)
+        self.features = features
+        self.labels = labels
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return (torch.from_numpy(self.features[index].astype(np.float32)),
+                torch.from_numpy(np.asarray(self.labels[index])))
@@ -0,0 +1,82 @@
+import torch
+
+
+def confusion_metrics(TP, FP, FN, TN, eps=1e-6):
+    """
+    precision, recall, TPR, FPR and F1 from the confusion counts. Only uses
+    arithmetic operators, so the counts may be numbers, numpy arrays or
+    pandas columns.
+    """
+    precision = TP / (FP + TP + eps)
+    recall = TP / (FN + TP + eps)
+    return {
+        'precision': precision,
+        'recall': recall,
+        'TPR': TP / (TP + FN + eps),
+        'FPR': FP / (FP + TN + eps),
+        'F1': 2 * precision * recall / (precision + recall + eps),
+    }
+
+
+class MultiLabelMetrics(object):
+    """
+    Streaming confusion counts of a multi-label classifier: update() with every
+    batch of outputs and labels, merge() the accumulators of other processes,
+    then finalize() into the correct_dict / confusion_matrix_dict of Solver.evaluate.
+    The counts stay on the device of the outputs until finalize.
+    """
+    KEYS = ['TP', 'TN', 'FP', 'FN']
+
+    def __init__(self, attr_names, threshold, device="cpu"):
+        self.attr_names = list(attr_names)
+        self.threshold = torch.tensor(list(threshold)[:len(self.attr_names)],
+                                      dtype=torch.float32, device=device)
+        self.counts = torch.zeros(len(self.KEYS), len(self.attr_names), dtype=torch.long, device=device)
+        self.num_samples = 0
+
+    def update(self, outputs, labels):
+        """outputs: [batch_size, num_attr] probabilities, labels: [batch_size, num_attr] 0/1."""
+        preds = outputs > self.threshold
+        labels = labels.to(preds.device) == 1
+        self.counts[0] += (preds & labels).sum(dim=0)
+        self.counts[1] += (~preds & ~labels).sum(dim=0)
+        self.counts[2] += (preds & ~labels).sum(dim=0)
+        self.counts[3] += (~preds & labels).sum(dim=0)
+        self.num_samples += labels.size(0)
+
+    def merge(self, other):
+        self.counts += other.counts.to(self.counts.device)
+        self.num_samples += other.num_samples
+        return self
+
+    def state_dict(self):
+        return {'counts': self.counts.cpu(), 'num_samples': self.num_samples}
+
+    def load_state_dict(self, state_dict):
+        self.counts = state_dict['counts'].to(self.counts.device)
+        self.num_samples = state_dict['num_samples']
+
+    def finalize(self, num_images=None):
+        """
+        Return (correct_dict, confusion_matrix_dict, mean_attributes_acc), the
+        accuracy in % of num_images, by default the number of samples seen.
+        """
+        if num_images is None:
+            num_images = self.num_samples
+        counts = self.counts.cpu().numpy()
+        TP, TN, FP, FN = counts
+        confusion_matrix_dict = {}
+        for key, count in zip(self.KEYS, counts):
+            confusion_matrix_dict[key] = count.tolist()
+        for key, value in confusion_metrics(TP, FP, FN, TN).items():
+            confusion_matrix_dict[key] = value.tolist()
+
+        correct_dict = {}
+        for j, attr in enumerate(self.attr_names):
+            correct_dict[attr] = int(TP[j] + TN[j]) * 100 / num_images
+
+        mean_attributes_acc = 0.0
+        for k, v in correct_dict.items():
+            mean_attributes_acc += v
+        mean_attributes_acc /= len(self.attr_names)
+        return correct_dict, confusion_matrix_dict, mean_attributes_acc
@@ -0,0 +1,87 @@
+import numpy as np
+
+from Module.calibration import sweep_thresholds
+
+
+def roc_auc(scores, labels):
+    """
+    The ROC-AUC of every attribute from the ranks of its scores (Mann-Whitney),
+    tied scores get their average rank. nan when a column has one class only.
+    scores, labels: [num_images, num_attr]
+    """
+    scores = np.asarray(scores, dtype=np.float32)
+    labels = np.asarray(labels) == 1
+    num_images = scores.shape[0]
+    order = np.argsort(scores, axis=0, kind='stable')
+    sorted_scores = np.take_along_axis(scores, order, axis=0)
+    sorted_labels = np.take_along_axis(labels, order, axis=0)
+
+    # the first and last position of the group of equal scores of every position.
+    position = np.broadcast_to(np.arange(num_images)[:, None], scores.shape)
+    new_group = np.ones(scores.shape, dtype=bool)
+    new_group[1:] = sorted_scores[1:] != sorted_scores[:-1]
+    group_start = np.maximum.accumulate(np.where(new_group, position, 0), axis=0)
+    group_end = np.ones(scores.shape, dtype=bool)
+    group_end[:-1] = new_group[1:]
+    group_stop = np.minimum.accumulate(np.where(group_end, position, num_images)[::-1], axis=0)[::-1]
+    ranks = (group_start + group_stop) / 2 + 1
+
+    positives = sorted_labels.sum(axis=0)
+    negatives = num_images - positives
+    rank_sum = (ranks * sorted_labels).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (rank_sum - positives * (positives + 1) / 2) / (positives * negatives)
+
+
+def ranking_curves(scores, labels):
+    """
+    The ROC and PR curves of every attribute at every distinct threshold, from
+    sweep_thresholds. Return a list of dicts of fpr, tpr, precision, recall and
+    thresholds arrays, ordered by decreasing threshold.
+    """
+    TP, FP, FN, TN, thresholds = sweep_thresholds(scores, labels)
+    curves = []
+    for j in range(TP.shape[1]):
+        valid = ~np.isnan(thresholds[:, j])
+        tp, fp, fn, tn = TP[valid, j], FP[valid, j], FN[valid, j], TN[valid, j]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            curves.append({
+                'fpr': fp / (fp + tn),
+                'tpr': tp / (tp + fn),
+                'precision': np.where(tp + fp > 0, tp / np.maximum(tp + fp, 1), 1.0),
+                'recall': tp / (tp + fn),
+                'thresholds': thresholds[valid, j],
+            })
+    return curves
+
+
+def average_precision(scores, labels):
+    """
+    The average precision of every attribute, sum over the distinct thresholds
+    of (recall_k - recall_k-1) * precision_k. nan when a column has no positive.
+    """
+    TP, FP, FN, TN, thresholds = sweep_thresholds(scores, labels)
+    valid = ~np.isnan(thresholds)
+    positives = TP[-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        recall = TP / positives
+        precision = TP / np.maximum(TP + FP, 1)
+    # the recall of the previous valid cut, the cuts inside tied scores are skipped.
+    rows = np.broadcast_to(np.arange(TP.shape[0])[:, None], TP.shape)
+    last_valid = np.maximum.accumulate(np.where(valid, rows, 0), axis=0)
+    previous = np.take_along_axis(recall, last_valid[:-1], axis=0)
+    steps = np.where(valid[1:], recall[1:] - previous, 0.0)
+    return (steps * precision[1:]).sum(axis=0)
+
+
+def ranking_report(scores, labels, attr_names):
+    """The per attribute roc_auc and average_precision with their means, for the report json."""
+    auc = roc_auc(scores, labels)
+    ap = average_precision(scores, labels)
+    as_json = lambda values: [None if np.isnan(v) else float(v) for v in values]
+    return {
+        "mean_roc_auc": None if np.all(np.isnan(auc)) else float(np.nanmean(auc)),
+        "mean_average_precision": None if np.all(np.isnan(ap)) else float(np.nanmean(ap)),
+        "roc_auc": dict(zip(attr_names, as_json(auc))),
+        "average_precision": dict(zip(attr_names, as_json(ap))),
+    }
@@ -0,0 +1,56 @@
+import os
+import glob
+import numpy as np
+import torch
+
+from Module.metrics import MultiLabelMetrics
+
+
+def score_prefix(score_dir, exp_version, model_type, epoch, mode):
+    """e.g. ./result/scores/v7-Resnet50-validate-epoch3, the arrays add .scores.npy, .labels.npy and .attrs.npy"""
+    return os.path.join(score_dir, "{}-{}-{}-epoch{}".format(exp_version, model_type, mode, epoch))
+
+
+def save_scores(prefix, scores, labels, attr_names):
+    """
+    scores: [num_images, num_attr] sigmoid outputs, kept as float32 so the
+    cached metrics are the same as the ones of the run.
+    labels: [num_images, num_attr] 0/1, kept as uint8.
+    """
+    os.makedirs(os.path.dirname(prefix) or ".", exist_ok=True)
+    np.save(prefix + ".scores.npy", np.asarray(scores, dtype=np.float32))
+    np.save(prefix + ".labels.npy", np.asarray(labels, dtype=np.uint8))
+    np.save(prefix + ".attrs.npy", np.array(attr_names))
+
+
+def load_scores(prefix, mmap_mode=None):
+    """Return (scores, labels, attr_names) saved by save_scores."""
+    scores = np.load(prefix + ".scores.npy", mmap_mode=mmap_mode)
+    labels = np.load(prefix + ".labels.npy", mmap_mode=mmap_mode)
+    attr_names = np.load(prefix + ".attrs.npy").tolist()
+    return scores, labels, attr_names
+
+
+def cached_epochs(score_dir, exp_version, model_type, mode):
+    """
+    The epochs of an experiment with cached scores, the numbered ones first in order,
+    then the validate subset ones ("<epoch>-subset") in order.
+    """
+    prefix = score_prefix(score_dir, exp_version, model_type, "", mode)
+    epochs = [path[len(prefix):-len(".scores.npy")] for path in glob.glob(glob.escape(prefix) + "*.scores.npy")]
+    numbered = sorted(int(epoch) for epoch in epochs if epoch.isdigit())
+    subsets = [epoch for epoch in epochs if epoch.endswith("-subset") and epoch[:-len("-subset")].isdigit()]
+    subsets = sorted(subsets, key=lambda epoch: int(epoch[:-len("-subset")]))
+    others = sorted(epoch for epoch in epochs if not epoch.isdigit() and epoch not in subsets)
+    return numbered + subsets + others
+
+
+def cached_metrics(prefix, threshold, num_images=None):
+    """
+    Recompute (correct_dict, confusion_matrix_dict, mean_attributes_acc) of
+    Solver.evaluate from the cached scores, with any threshold.
+    """
+    scores, labels, attr_names = load_scores(prefix)
+    metrics = MultiLabelMetrics(attr_names, threshold)
+    metrics.update(torch.from_numpy(scores), torch.from_numpy(labels))
+    return metrics.finalize(num_images)
@@ -0,0 +1,43 @@
+import numpy as np
+
+
+def stratified_subset(labels, size, seed=1024):
+    """
+    The sorted indices of about size images, sampled in proportion from the
+    strata of the rarest positive attribute of every image, so the subset
+    keeps the rare attributes. labels: [num_images, num_attr] 0/1
+    """
+    labels = np.asarray(labels) == 1
+    num_images, num_attr = labels.shape
+    if size >= num_images:
+        return np.arange(num_images)
+    frequency = labels.sum(axis=0)
+    rarest = np.where(labels, frequency, num_images + 1).argmin(axis=1)
+    strata = np.where(labels.any(axis=1), rarest, num_attr)  # num_attr: no positive attribute
+    rng = np.random.RandomState(seed)
+    chosen = []
+    for stratum in np.unique(strata):
+        members = np.flatnonzero(strata == stratum)
+        count = int(round(len(members) * size / num_images))
+        chosen.append(rng.choice(members, count, replace=False))
+    return np.sort(np.concatenate(chosen))
+
+
+def image_accuracy(scores, labels, threshold):
+    """The accuracy in % over the attributes of every image, [num_images]."""
+    threshold = np.asarray(threshold, dtype=np.float32)[:scores.shape[1]]
+    return ((scores > threshold) == (labels == 1)).mean(axis=1) * 100
+
+
+def bootstrap_interval(values, num_samples=1000, confidence=0.95, seed=1024, chunk_size=100):
+    """The percentile bootstrap interval (low, high) of the mean of values."""
+    values = np.asarray(values, dtype=np.float64)
+    rng = np.random.RandomState(seed)
+    means = []
+    # resample by chunks, num_samples * len(values) indices at once would not fit in memory.
+    for start in range(0, num_samples, chunk_size):
+        count = min(chunk_size, num_samples - start)
+        means.append(values[rng.randint(0, len(values), size=(count, len(values)))].mean(axis=1))
+    means = np.concatenate(means)
+    alpha = (1 - confidence) / 2 * 100
+    return float(np.percentile(means, alpha)), float(np.percentile(means, 100 - alpha))
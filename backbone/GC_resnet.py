@@ -70,13 +70,13 @@ class GCLayer(nn.Module):
         if self.pool == 'att':
             input_x = x
             # [N, C, H * W]
-            input_x = input_x.view(batch, channel, height * width)
+            input_x = input_x.reshape(batch, channel, height * width)
             # [N, 1, C, H * W]
             input_x = input_x.unsqueeze(1)
             # [N, 1, H, W]
             context_mask = self.conv_mask(x)
             # [N, 1, H * W]
-            context_mask = context_mask.view(batch, 1, height * width)
+            context_mask = context_mask.reshape(batch, 1, height * width)
             # [N, 1, H * W]
             context_mask = self.softmax(context_mask)
             # [N, 1, H * W, 1]
@@ -84,7 +84,7 @@ class GCLayer(nn.Module):
             # [N, 1, C, 1]
             context = torch.matmul(input_x, context_mask)
             # [N, C, 1, 1]
-            context = context.view(batch, channel, 1, 1)
+            context = context.reshape(batch, channel, 1, 1)
         else:
             # [N, C, 1, 1]
             context = self.avg_pool(x)
@@ -30,7 +30,7 @@ class BasicConv(nn.Module):
 
 class Flatten(nn.Module):
     def forward(self, x):
-        return x.view(x.size(0), -1)
+        return x.reshape(x.size(0), -1)
 
 class ChannelGate(nn.Module):
     def __init__(self, gate_channels, reduction_ratio=16 \
@@ -70,8 +70,12 @@ class ChannelGate(nn.Module):
 
 class ChannelPool(nn.Module):
     def forward(self, x):
-        return torch.cat( (torch.max(x,1)[0].unsqueeze(1), torch.mean(x,1) \
+        pooled = torch.cat( (torch.max(x,1)[0].unsqueeze(1), torch.mean(x,1) \
                 .unsqueeze(1)), dim=1 )
+        if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+            # the cat of the single channel maps is NCHW, keep the layout of x for the spatial conv.
+            pooled = pooled.contiguous(memory_format=torch.channels_last)
+        return pooled
 
 class SpatialGate(nn.Module):
     def __init__(self):
@@ -279,7 +283,7 @@ class ResNet(nn.Module):
             x = self.avgpool(x)
         else:
             x = F.avg_pool2d(x, 4)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
         return x
 
@@ -20,18 +20,22 @@ class SpatialGroupEnhance(nn.Module):
 
     def forward(self, x): # (b, c, h, w)
         b, c, h, w = x.size()
-        x = x.view(b * self.groups, -1, h, w) 
-        xn = x * self.avg_pool(x)
-        xn = xn.sum(dim=1, keepdim=True)
-        t = xn.view(b * self.groups, -1)
-        t = t - t.mean(dim=1, keepdim=True)
-        std = t.std(dim=1, keepdim=True) + 1e-5
+        channels_last = x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous()
+        # the groups get a dimension of their own instead of joining the batch: splitting
+        # the channels is a view in both layouts, a channels last x is not copied to NCHW.
+        xg = x.reshape(b, self.groups, -1, h, w)
+        xn = xg * self.avg_pool(x).reshape(b, self.groups, -1, 1, 1)
+        xn = xn.sum(dim=2)
+        t = xn.reshape(b, self.groups, -1)
+        t = t - t.mean(dim=2, keepdim=True)
+        std = t.std(dim=2, keepdim=True) + 1e-5
         t = t / std
-        t = t.view(b, self.groups, h, w)
+        t = t.reshape(b, self.groups, h, w)
         t = t * self.weight + self.bias
-        t = t.view(b * self.groups, 1, h, w)
-        x = x * self.sig(t)
-        x = x.view(b, c, h, w)
+        x = xg * self.sig(t).unsqueeze(2)
+        x = x.reshape(b, c, h, w)
+        if channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
         return x
 
 def conv3x3(in_planes, out_planes, stride=1):
@@ -182,7 +186,7 @@ class ResNet(nn.Module):
         x = self.layer4(x)
 
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
 
         return x
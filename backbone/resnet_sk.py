@@ -99,7 +99,7 @@ class Bottleneck(nn.Module):
         d  = self.avg_pool(d1) + self.avg_pool(d2)
         d = F.relu(self.bn_fc1(self.conv_fc1(d)))
         d = self.conv_fc2(d)
-        d = torch.unsqueeze(d, 1).view(-1, 2, self.D, 1, 1)
+        d = torch.unsqueeze(d, 1).reshape(-1, 2, self.D, 1, 1)
         d = F.softmax(d, 1)
         d1 = d1 * d[:, 0, :, :, :].squeeze(1)
         d2 = d2 * d[:, 1, :, :, :].squeeze(1)
@@ -179,7 +179,7 @@ class ResNet(nn.Module):
         x = self.layer4(x)
 
         x = self.avgpool(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
 
         return x
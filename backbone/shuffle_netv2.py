@@ -27,15 +27,21 @@ def channel_shuffle(x, groups):
     batchsize, num_channels, height, width = x.data.size()
 
     channels_per_group = num_channels // groups
+
+    if x.is_contiguous(memory_format=torch.channels_last) and not x.is_contiguous():
+        # shuffle the channels of the NHWC memory, the result stays channels last.
+        x = x.permute(0, 2, 3, 1).reshape(batchsize, height, width, groups, channels_per_group)
+        x = torch.transpose(x, 3, 4).contiguous()
+        return x.reshape(batchsize, height, width, num_channels).permute(0, 3, 1, 2)
     
     # reshape
-    x = x.view(batchsize, groups, 
+    x = x.reshape(batchsize, groups, 
         channels_per_group, height, width)
 
     x = torch.transpose(x, 1, 2).contiguous()
 
     # flatten
-    x = x.view(batchsize, -1, height, width)
+    x = x.reshape(batchsize, -1, height, width)
 
     return x
     
@@ -150,7 +156,8 @@ class ShuffleNetV2(nn.Module):
 
         # building last several layers
         self.conv_last      = conv_1x1_bn(input_channel, self.stage_out_channels[-1])
-        self.globalpool = nn.Sequential(nn.AvgPool2d(int(input_size/32)))              
+        # same as AvgPool2d(input_size/32) at input_size, and works with any input resolution.
+        self.globalpool = nn.Sequential(nn.AdaptiveAvgPool2d(1))
     
         # building classifier
         self.classifier = nn.Sequential(nn.Linear(self.stage_out_channels[-1], n_class))
@@ -161,7 +168,7 @@ class ShuffleNetV2(nn.Module):
         x = self.features(x)
         x = self.conv_last(x)
         x = self.globalpool(x)
-        x = x.view(-1, self.stage_out_channels[-1])
+        x = x.reshape(-1, self.stage_out_channels[-1])
         x = self.classifier(x)
         return x
 
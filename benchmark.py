@@ -0,0 +1,433 @@
+import argparse
+import copy
+import os
+import tempfile
+import time
+import numpy as np
+import torch
+from torch.utils import data
+from PIL import Image
+import torch.nn as nn
+import torch.nn.functional as F
+from CelebA import FastCollate
+from FaceAttr_baseline_model import FaceAttrModel, FeatureExtraction, __SUPPORT_MODEL__
+from Module.amp import autocast
+from Module.compile import artifact_path, set_compile_cache, trace_model, freeze_model
+from Module.checkpoint import AsyncCheckpointer, load_checkpoint, rng_state, states_equal
+import config as cfg
+
+"""
+Benchmarks of the input pipeline and of the model, e.g.
+    python benchmark.py collate --batch_size 128 --num_workers 4
+    python benchmark.py decode --num_images 1000
+    python benchmark.py amp --batch_size 32 --num_batches 5 --models Resnet18 Resnet101
+    python benchmark.py channels_last --batch_size 8 --num_batches 5
+    python benchmark.py compile --batch_size 32 --num_batches 5 --backbones Resnet50 se_resnet50
+    python benchmark.py checkpoint --batch_size 8 --backbones Resnet18
+"""
+
+parser = argparse.ArgumentParser(description='FaceAttr benchmarks')
+parser.add_argument('command', choices=['collate', 'decode', 'amp', 'channels_last', 'compile', 'checkpoint'])
+parser.add_argument('--batch_size', default=128, type=int)
+parser.add_argument('--num_workers', default=0, type=int)
+parser.add_argument('--num_batches', default=50, type=int)
+parser.add_argument('--pin_memory', action='store_true', default=False)
+parser.add_argument('--image_dir', default=cfg.image_dir, type=str)
+parser.add_argument('--num_images', default=500, type=int)
+parser.add_argument('--sizes', default=[224, 160, 112, 89, 64, 44], type=int, nargs='+',
+                    help='the input resolutions of the decode benchmark')
+parser.add_argument('--models', default=None, nargs='+', help='the backbones of the amp benchmark, default: all of them')
+parser.add_argument('--input_size', default=cfg.input_size, type=int)
+parser.add_argument('--backbones', default=None, nargs='+',
+                    help='the backbones of the channels_last, compile and checkpoint benchmarks, default: all of them')
+parser.add_argument('--tolerance', default=1e-3, type=float,
+                    help='the largest relative difference of the channels_last or compiled outputs (and gradients)')
+parser.add_argument('--compile_dir', default=cfg.compile_dir, type=str,
+                    help='the cache of the compiled graphs of the compile benchmark')
+args = parser.parse_args()
+
+
+class SyntheticCelebA(data.Dataset):
+    """Return the same transformed sample, so only the collate and transfer costs are measured."""
+    def __init__(self, size, label_as_list=False):
+        self.size = size
+        self.image = torch.rand(3, 224, 224)
+        self.label = torch.randint(0, 2, (40,))
+        self.label_as_list = label_as_list
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, index):
+        if self.label_as_list:
+            return self.image, self.label.tolist()
+        return self.image, self.label
+
+
+def time_loader(data_loader, stack_labels=False):
+    start_time = time.time()
+    for images, labels in data_loader:
+        if stack_labels:
+            labels = torch.stack(labels).t()
+    return time.time() - start_time
+
+
+def benchmark_collate():
+    size = args.batch_size * args.num_batches
+    candidates = [
+        ("list labels + torch.stack", SyntheticCelebA(size, label_as_list=True), None, True),
+        ("default collate", SyntheticCelebA(size), None, False),
+        ("FastCollate", SyntheticCelebA(size), FastCollate(args.pin_memory and args.num_workers == 0), False),
+    ]
+    for name, dataset, collate, stack_labels in candidates:
+        data_loader = data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers,
+                                      pin_memory=args.pin_memory and (collate is None or args.num_workers > 0),
+                                      collate_fn=collate if collate is not None else data.dataloader.default_collate)
+        cost = time_loader(data_loader, stack_labels)
+        print("{:<28} {:8.2f} ms/batch {:10.1f} images/s".format(
+            name, cost * 1000 / args.num_batches, size / cost))
+
+
+def decode_resized(path, size, draft):
+    image = Image.open(path)
+    if draft:
+        image.draft('RGB', (size, size))
+    return np.asarray(image.convert('RGB').resize((size, size), Image.BILINEAR), dtype=np.float32)
+
+
+def benchmark_decode():
+    """
+    Decode + resize cost of every input resolution, with the full decode and with
+    the reduced scale decode of Image.draft. The accuracy of the draft decode is
+    the PSNR of its resized images against the full decode ones.
+    """
+    filenames = sorted(os.listdir(args.image_dir))[:args.num_images]
+    paths = [os.path.join(args.image_dir, filename) for filename in filenames]
+    print("{:>5} {:>14} {:>14} {:>9} {:>9}".format("size", "full ms/image", "draft ms/image", "speedup", "PSNR dB"))
+    for size in args.sizes:
+        costs = []
+        images = []
+        for draft in [False, True]:
+            start_time = time.time()
+            images.append([decode_resized(path, size, draft) for path in paths])
+            costs.append((time.time() - start_time) * 1000 / len(paths))
+        mse = np.mean([np.mean((full - drafted) ** 2) for full, drafted in zip(*images)])
+        psnr = float('inf') if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+        print("{:>5} {:>14.3f} {:>14.3f} {:>9.2f} {:>9.2f}".format(size, costs[0], costs[1], costs[0] / costs[1], psnr))
+
+
+# every backbone of FeatureExtraction, gc_resnet is built here as FeatureExtraction does not
+# import it (it needs mmcv).
+BACKBONES = ["Resnet18", "Resnet50", "Resnet101", "Resnet152", "densenet121", "gc_resnet50",
+             "se_resnet50", "se_resnet101", "sge_resnet50", "sge_resnet101", "sk_resnet50", "sk_resnet101",
+             "shuffle_netv2", "cbam_resnet50", "cbam_resnet101"]
+# the --model_type choices of main.py.
+MODEL_TYPES = ["Resnet101", "Resnet152", "Resnet50", "gc_resnet101", "gc_resnet50", "se_resnet101", "se_resnet50",
+               "sk_resnet101", "sk_resnet50", "sge_resnet101", "sge_resnet50", "shuffle_netv2", "densenet121",
+               "cbam_resnet101", "cbam_resnet50"]
+
+
+def build_backbone(model_type):
+    if model_type in __SUPPORT_MODEL__ and model_type != "densenet121":
+        # the full model, with the flatten of the classifier. The classifier of densenet121
+        # does not match its unpooled features.
+        return FaceAttrModel(model_type, False, cfg.selected_attrs)
+    if model_type in ["gc_resnet50", "gc_resnet101"]:
+        from backbone import GC_resnet
+        return nn.Sequential(*list(getattr(GC_resnet, model_type)(2).children())[:-1])
+    return FeatureExtraction(False, model_type)
+
+
+def images_per_second(model, images, labels=None, amp=False, train=False, forward=None):
+    """
+    Train steps (forward, fp32 loss, backward, SGD step) or eval forward passes of model,
+    called through forward when given (e.g. its compiled graph). With labels the loss is
+    computed from the logits, else (e.g. the backbones without a classifier) from a fixed
+    projection of the outputs.
+    """
+    device_type = images.device.type
+    if forward is None:
+        forward = model.logits if labels is not None else model
+    optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+    model.train(train)
+    projection = None
+    for i in range(args.num_batches + 1):
+        if i == 1:  # the first batch warms up
+            start_time = time.time()
+        with torch.set_grad_enabled(train):
+            with autocast(device_type, amp):
+                outputs = forward(images)
+            if train:
+                if labels is not None:
+                    loss = F.binary_cross_entropy_with_logits(outputs.float(), labels)
+                else:
+                    if projection is None:
+                        projection = torch.randn(outputs.shape, generator=torch.Generator().manual_seed(0))
+                        projection = projection.to(outputs.device)
+                    loss = (outputs.float() * projection).sum()
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+    if device_type == "cuda":
+        torch.cuda.synchronize()
+    return args.batch_size * args.num_batches / (time.time() - start_time)
+
+
+def benchmark_amp():
+    """
+    images/s of every backbone in fp32 and under autocast (bf16 on the cpu, fp16 on cuda),
+    the full FaceAttrModel where build_backbone has it, else the features of the backbone.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    images = torch.rand(args.batch_size, 3, args.input_size, args.input_size, device=device)
+    labels = torch.randint(0, 2, (args.batch_size, len(cfg.selected_attrs)), device=device).float()
+    print("{:<14} {:>6} {:>12} {:>12} {:>8}".format("model", "mode", "fp32 img/s", "amp img/s", "speedup"))
+    for model_type in args.models or BACKBONES:
+        try:
+            model = build_backbone(model_type).to(device)
+        except ImportError as e:
+            print("{:<14} skipped: {}".format(model_type, e))
+            continue
+        model_labels = labels if hasattr(model, "logits") else None
+        for train in [True, False]:
+            fp32 = images_per_second(model, images, model_labels, False, train)
+            amp = images_per_second(model, images, model_labels, True, train)
+            print("{:<14} {:>6} {:>12.1f} {:>12.1f} {:>8.2f}".format(
+                model_type, "train" if train else "eval", fp32, amp, amp / fp32))
+
+
+def relative_difference(x, y):
+    return ((x - y).abs().max() / y.abs().max().clamp(min=1e-12)).item()
+
+
+def channels_last_parity(model, images):
+    """
+    The largest relative difference of the eval outputs, and of the parameter gradients
+    of a train forward and backward, between the contiguous and the channels last layouts.
+    It runs in float64: with small batches the fp32 round off of the train batch norms
+    is amplified far beyond any layout error.
+    """
+    results = []
+    model, images = copy.deepcopy(model).double(), images.double()
+    # the train forward updates the batch norm statistics.
+    state_dict = copy.deepcopy(model.state_dict())
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        torch.manual_seed(0)  # the same dropout masks
+        model.load_state_dict(state_dict)
+        model.to(memory_format=memory_format)
+        inputs = images.contiguous(memory_format=memory_format)
+        model.eval()
+        with torch.no_grad():
+            outputs = model(inputs)
+        model.train()
+        model.zero_grad()
+        # a fixed projection, the gradients of a plain sum through the batch norms are mostly round off.
+        projection = torch.randn(outputs.shape, generator=torch.Generator().manual_seed(0), dtype=outputs.dtype)
+        (model(inputs) * projection.to(outputs.device)).sum().backward()
+        # relative to the largest gradient of the model, some of them (e.g. the bias of a batch
+        # norm followed by another batch norm in shuffle_netv2) are zero up to the round off.
+        grads = torch.cat([p.grad.detach().flatten() for p in model.parameters() if p.grad is not None])
+        results.append((outputs, grads))
+    (outputs, grads), (cl_outputs, cl_grads) = results
+    return relative_difference(cl_outputs, outputs), relative_difference(cl_grads, grads)
+
+
+def nchw_modules(model, images):
+    """
+    The modules of model whose feature map outputs are not channels last on channels last
+    images, e.g. a reshape or a .contiguous() that copies them back to NCHW.
+    """
+    names = {module: name for name, module in model.named_modules()}
+    found = []
+
+    def check_layout(module, inputs, output):
+        if (torch.is_tensor(output) and output.dim() == 4 and output.shape[1] > 1
+                and output.shape[2] * output.shape[3] > 1
+                and not output.is_contiguous(memory_format=torch.channels_last)):
+            found.append(names[module] or type(module).__name__)
+
+    hooks = [module.register_forward_hook(check_layout) for module in names]
+    model.to(memory_format=torch.channels_last)
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(images.contiguous(memory_format=torch.channels_last))
+    finally:
+        for hook in hooks:
+            hook.remove()
+    return found
+
+
+def benchmark_channels_last():
+    """
+    Parity of the outputs and gradients of every backbone of build_backbone in the channels
+    last layout, the feature maps that fall back to NCHW inside it, and the eval images/s
+    of both layouts. This is the parity check of the channels_last option: it exits with
+    an error if a backbone is off by more than the tolerance or does not keep the layout,
+    and lists the backbones it could not build.
+    """
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    images = torch.rand(args.batch_size, 3, args.input_size, args.input_size, device=device)
+    print("{:<16} {:>12} {:>12} {:>8} {:>12} {:>12} {:>8}".format(
+        "model", "output diff", "grad diff", "NCHW", "NCHW img/s", "NHWC img/s", "speedup"))
+    failed, skipped = [], []
+    for model_type in args.backbones or BACKBONES:
+        try:
+            model = build_backbone(model_type).to(device)
+        except ImportError as e:
+            print("{:<16} skipped: {}".format(model_type, e))
+            skipped.append(model_type)
+            continue
+        output_diff, grad_diff = channels_last_parity(model, images)
+        nchw_outputs = nchw_modules(model, images)
+        nchw = images_per_second(model.to(memory_format=torch.contiguous_format), images)
+        nhwc = images_per_second(model.to(memory_format=torch.channels_last),
+                                 images.contiguous(memory_format=torch.channels_last))
+        print("{:<16} {:>12.2e} {:>12.2e} {:>8} {:>12.1f} {:>12.1f} {:>8.2f}".format(
+            model_type, output_diff, grad_diff, len(nchw_outputs), nchw, nhwc, nhwc / nchw))
+        if len(nchw_outputs) > 0:
+            print("    NCHW outputs: {}".format(", ".join(nchw_outputs[:5])))
+        if max(output_diff, grad_diff) > args.tolerance or len(nchw_outputs) > 0:
+            failed.append(model_type)
+    if len(skipped) > 0:
+        print("not checked: {}".format(", ".join(skipped)))
+    if len(failed) > 0:
+        raise SystemExit("channels_last differs from the contiguous layout or falls back to NCHW: {}".format(
+            ", ".join(failed)))
+
+
+def timed(call, *inputs):
+    start_time = time.time()
+    outputs = call(*inputs)
+    return outputs, time.time() - start_time
+
+
+def benchmark_compile():
+    """
+    Parity with eager mode of the torch.compile outputs (eval and train mode) and of the
+    frozen TorchScript outputs (eval mode) of every --model_type, with the time of the
+    first call (which compiles, unless compile_dir has the graphs of an earlier run) and
+    the images/s of each. Inductor uses the eager random numbers, so the train outputs
+    see the same dropout masks. Exit with an error above the tolerance.
+    """
+    import torch._inductor.config
+    torch._inductor.config.fallback_random = True
+    set_compile_cache(args.compile_dir)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    images = torch.rand(args.batch_size, 3, args.input_size, args.input_size, device=device)
+    print("{:<16} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "model", "compile s", "trace s", "eval diff", "train diff", "script diff",
+        "eager img/s", "compile", "script", "train x"))
+    failed = []
+    for model_type in args.backbones or MODEL_TYPES:
+        try:
+            model = build_backbone(model_type).to(device).eval()
+        except ImportError as e:
+            print("{:<16} skipped: {}".format(model_type, e))
+            continue
+        state_dict = copy.deepcopy(model.state_dict())
+        compiled = torch.compile(model)
+        with torch.no_grad():
+            expected = model(images)
+            outputs, compile_time = timed(compiled, images)
+        path = artifact_path(args.compile_dir, model_type, len(cfg.selected_attrs), tuple(images.shape), device.type,
+                             extension=".ts")
+        script, trace_time = timed(lambda x: freeze_model(trace_model(model, x, path), state_dict), images)
+        with torch.no_grad():
+            script_outputs = script(images)
+        eval_diff = relative_difference(outputs, expected)
+        script_diff = relative_difference(script_outputs, expected)
+        eval_speed = [images_per_second(model, images, forward=forward) for forward in [model, compiled, script]]
+
+        # train mode, the batch norms use the batch statistics and update the running ones.
+        train_outputs = []
+        for forward in [model, compiled]:
+            model.load_state_dict(state_dict)
+            model.train()
+            torch.manual_seed(0)  # the same dropout masks
+            with torch.no_grad():
+                train_outputs.append(forward(images))
+        train_diff = relative_difference(train_outputs[1], train_outputs[0])
+        train_speed = [images_per_second(model, images, train=True, forward=forward) for forward in [model, compiled]]
+        print("{:<16} {:>10.1f} {:>10.1f} {:>10.2e} {:>10.2e} {:>10.2e} {:>10.1f} {:>10.1f} {:>10.1f} {:>10.2f}".format(
+            model_type, compile_time, trace_time, eval_diff, train_diff, script_diff,
+            eval_speed[0], eval_speed[1], eval_speed[2], train_speed[1] / train_speed[0]))
+        if max(eval_diff, train_diff, script_diff) > args.tolerance:
+            failed.append(model_type)
+    if len(failed) > 0:
+        raise SystemExit("the compiled graphs differ from eager mode: {}".format(", ".join(failed)))
+
+
+def train_state(model_type, images, labels):
+    """The model, SGD and MultiStepLR of Solver after a few steps, the scheduler past its first milestone."""
+    model = FaceAttrModel(model_type, False, cfg.selected_attrs)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer, [30, 80], gamma=0.1)
+    for step in range(35):
+        if step < 2:  # the momentum buffers
+            optimizer.zero_grad()
+            F.binary_cross_entropy_with_logits(model.logits(images), labels).backward()
+            optimizer.step()
+        scheduler.step()
+    return model, optimizer, scheduler
+
+
+def benchmark_checkpoint():
+    """
+    The round trip of a checkpoint through the AsyncCheckpointer of Solver: the model,
+    optimizer and scheduler states must load back equal, and a restored scheduler must
+    decay the learning rate at the same steps. With the time of the snapshot (on the
+    training thread) and of the background write. Exit with an error if they differ.
+    """
+    images = torch.rand(args.batch_size, 3, args.input_size, args.input_size)
+    labels = torch.randint(0, 2, (args.batch_size, len(cfg.selected_attrs))).float()
+    print("{:<16} {:>12} {:>12} {:>10} {:>10}".format("model", "snapshot ms", "write ms", "MB", "equal"))
+    failed = []
+    for model_type in args.backbones or ["Resnet18"]:
+        model, optimizer, scheduler = train_state(model_type, images, labels)
+        state = {"model": model.state_dict(), "optimizer": optimizer.state_dict(),
+                 "scheduler": scheduler.state_dict(), "rng": rng_state()}
+        checkpointer = AsyncCheckpointer()
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "checkpoint.pth")
+            snapshot_time = timed(checkpointer.save, state, path)[1]
+            write_time = timed(checkpointer.wait)[1]
+            size = os.path.getsize(path) / 2**20
+            loaded = load_checkpoint(path)
+
+        # restore into fresh objects, then run the schedulers past the second milestone.
+        restored_model = FaceAttrModel(model_type, False, cfg.selected_attrs)
+        restored_model.load_state_dict(loaded["model"])
+        restored_optimizer = torch.optim.SGD(restored_model.parameters(), lr=0.01, momentum=0.9)
+        restored_optimizer.load_state_dict(loaded["optimizer"])
+        restored = torch.optim.lr_scheduler.MultiStepLR(restored_optimizer, [30, 80], gamma=0.1)
+        restored.load_state_dict(loaded["scheduler"])
+        lrs = []
+        for sched in [scheduler, restored]:
+            for step in range(50):
+                sched.step()
+            lrs.append(sched.get_last_lr())
+        equal = (all(states_equal(state[key], loaded[key]) for key in state)
+                 and states_equal(optimizer.state_dict(), restored_optimizer.state_dict())
+                 and lrs[0] == lrs[1])
+        print("{:<16} {:>12.1f} {:>12.1f} {:>10.1f} {:>10}".format(
+            model_type, snapshot_time * 1000, write_time * 1000, size, str(equal)))
+        if not equal:
+            failed.append(model_type)
+    if len(failed) > 0:
+        raise SystemExit("the checkpoints do not load back equal: {}".format(", ".join(failed)))
+
+
+if __name__ == "__main__":
+    if args.command == 'collate':
+        benchmark_collate()
+    elif args.command == 'decode':
+        benchmark_decode()
+    elif args.command == 'amp':
+        benchmark_amp()
+    elif args.command == 'channels_last':
+        benchmark_channels_last()
+    elif args.command == 'compile':
+        benchmark_compile()
+    elif args.command == 'checkpoint':
+        benchmark_checkpoint()
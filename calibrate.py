@@ -0,0 +1,49 @@
+import os
+import json
+import argparse
+import config as cfg
+from Module.calibration import calibrate_thresholds, save_thresholds
+from Module.score_cache import score_prefix, cached_epochs, load_scores
+
+"""
+Choose the threshold of every attribute on the validate scores cached by
+`python main.py --score_cache`, e.g.
+    python calibrate.py v7 Resnet50 --metric F1
+then train or predict with --threshold_path ./result/v7-Resnet50-thresholds.json
+"""
+
+parser = argparse.ArgumentParser(description='Calibrate the attribute thresholds')
+parser.add_argument('exp_version', type=str)
+parser.add_argument('model_type', type=str)
+parser.add_argument('--metric', choices=['F1', 'accuracy'], default='F1')
+parser.add_argument('--epoch', default=None, type=str,
+                    help='the validate epoch, by default the best_epoch of the report or the last cached one')
+parser.add_argument('--score_dir', default=cfg.score_dir, type=str)
+parser.add_argument('--output', default=None, type=str)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    name = args.exp_version + "-" + args.model_type
+    epoch = args.epoch
+    report_path = "./result/" + name + "-report.json"
+    if epoch == None and os.path.exists(report_path):
+        with open(report_path) as f:
+            epoch = json.load(f).get("best_epoch")
+    if epoch == None:
+        epochs = cached_epochs(args.score_dir, args.exp_version, args.model_type, "validate")
+        if not epochs:
+            raise ValueError("no validate scores of {} in {}, train with --score_cache".format(name, args.score_dir))
+        numbered = [epoch for epoch in epochs if isinstance(epoch, int)]
+        epoch = numbered[-1] if numbered else epochs[-1]
+
+    prefix = score_prefix(args.score_dir, args.exp_version, args.model_type, epoch, "validate")
+    if not os.path.exists(prefix + ".scores.npy"):
+        # with validate_subset, an epoch without a full validation only has its subset scores.
+        prefix = score_prefix(args.score_dir, args.exp_version, args.model_type, "{}-subset".format(epoch), "validate")
+    scores, labels, attr_names = load_scores(prefix)
+    thresholds, values = calibrate_thresholds(scores, labels, args.metric)
+    for attr, threshold, value in zip(attr_names, thresholds, values):
+        print("{}: threshold {:.4f}, {} {:.4f}".format(attr, threshold, args.metric, value))
+    output = args.output if args.output != None else "./result/" + name + "-thresholds.json"
+    save_thresholds(output, attr_names, thresholds, args.metric)
+    print("The thresholds of epoch {} are saved in {}".format(epoch, output))
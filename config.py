@@ -31,6 +31,124 @@ log_dir = "./log"
 image_dir = "../../dataset/CelebA/Img/img_align_celeba/" 
 attr_path = "../../dataset/CelebA/Anno/list_attr_celeba.txt"
 
+# ------------- dataset backend ------------------ #
+# folder: read the jpg files in image_dir one by one.
+# packed: read the jpg bytes from the split containers in packed_dir,
+#         built by `python prepare_data.py pack`.
+# decoded: read the decoded uint8 images from the split shards in decoded_dir,
+#         built by `python prepare_data.py decode`. No jpg decoding while training,
+#         but the shards take about 22GB.
+# stream: read the tar shards in shard_dir sequentially, shuffled with a buffer
+#         of shuffle_buffer images, built by `python prepare_data.py shards`.
+data_backend = "folder"
+packed_dir = "../../dataset/CelebA/packed/"
+decoded_dir = "../../dataset/CelebA/decoded/"
+shard_dir = "../../dataset/CelebA/shards/"
+shuffle_buffer = 2000
+
+# ------------- data loader ----------------------- #
+num_workers = 1
+prefetch_factor = 2  # batches loaded in advance by each worker
+persistent_workers = False  # keep the workers alive between epochs
+pin_memory = True  # only used on cuda
+# measure the images/s of a few num_workers and prefetch_factor settings
+# when the train loader is built, and use the fastest.
+loader_autotune = False
+
+# ------------- input resolution ----------------- #
+# the images are resized to input_size * input_size (224 for the imagenet backbones).
+input_size = 224
+# decode the jpg files directly near input_size with the DCT scaling of libjpeg,
+# it only saves work when input_size <= 89 (half of 178).
+draft_decode = False
+
+# ------------- batch augmentation --------------- #
+# the workers only decode the images, the flip, rotation, resize and
+# normalization run on the whole batch on the device (Module/batch_augmentation.py).
+batch_augment = False
+# random brightness, contrast, saturation and hue per image, only with batch_augment.
+color_augment = False
+
+# ------------- evaluation cache ----------------- #
+# "": decode and transform the validate/test images on every evaluation.
+# "uint8"/"float16": keep the preprocessed images after the first evaluation,
+# in RAM up to eval_cache_budget GB per split, else in a memmap file in eval_cache_dir.
+# uint8 is lossless for the Resize + ToTensor images; with batch_augment the resized
+# images are not integer pixels and are kept in float16.
+eval_cache = ""
+eval_cache_budget = 8
+eval_cache_dir = "./result/eval_cache/"
+# evaluate the validate/test batches in eval_workers cpu processes, each
+# with a copy of the model, and merge their confusion counts. 1: in this process.
+eval_workers = 1
+# validate a snapshot of the weights of every epoch in max(1, eval_workers) cpu
+# processes while the next epoch trains, the best model is chosen as the results come.
+async_validate = False
+
+# ------------- validation schedule -------------- #
+validate_every = 1  # validate every validate_every epochs, and after the last one
+# validate on a fixed subset of about validate_subset images, stratified by the
+# rarest positive attribute of every image, 0: the whole validate set. When the
+# bootstrap intervals of a new candidate and of the best model overlap, both are
+# compared on the whole validate set.
+validate_subset = 0
+bootstrap_samples = 1000  # resamples for the interval of the mean accuracy, 0: no interval
+confidence = 0.95
+
+# ------------- mixed precision ------------------ #
+# run the forward passes under autocast, bf16 on the cpu and fp16 (with loss
+# scaling) on cuda. The losses are computed in fp32 from the logits.
+amp = False
+
+# ------------- memory format -------------------- #
+# keep the model weights and the input images in the NHWC (channels last) layout,
+# which the cpu (oneDNN) and the tensor core convolutions run faster on.
+channels_last = False
+
+# ------------- compiled graphs ------------------ #
+# eager, compile: torch.compile the train and eval passes, torchscript: evaluate with
+# a traced, frozen and optimized graph (in fp32). The graphs are cached in compile_dir
+# per model_type and input shape, later processes load them instead of compiling.
+graph_mode = "eager"
+compile_dir = "./result/compiled/"
+
+# ------------- distributed ---------------------- #
+# DistributedDataParallel training, one process per rank launched by torchrun, e.g.
+#   torchrun --nproc_per_node 8 main.py --distributed --batch_size 32
+# batch_size is per process. The ranks split the train and the evaluation batches,
+# the metrics are reduced over all of them and only the rank 0 writes files.
+distributed = False
+dist_backend = "gloo"
+
+# ------------- linear probe --------------------- #
+# keep the FeatureExtraction trunk fixed: its pooled features of every split are
+# computed once into fp16 memmaps of feature_dir (per model_type, input_size and
+# trunk weights), then only the FeatureClassfier is trained and evaluated on them.
+linear_probe = False
+feature_dir = "./result/features/"
+
+# ------------- checkpoint ----------------------- #
+# the model, optimizer, scheduler, random states, data order position and best
+# model are written by a background thread to
+# checkpoint_dir/<exp_version>-<model_type>-checkpoint.pth, `python main.py --resume` continues from it.
+# The checkpoints are taken between the training steps (Ctrl-C keeps the last one). A resume
+# reproduces the uninterrupted run, except for the random transforms of the DataLoader
+# workers after a mid-epoch resume (or any resume with persistent_workers): the workers
+# restart their random streams. The batch_augment transforms run in the main process.
+checkpoint_dir = "./result/checkpoints/"
+# off by default, a checkpoint holds the model and the optimizer state. `--resume` saves
+# every epoch unless --checkpoint_every is given.
+checkpoint_every = 0  # epochs, 0: no checkpoint at the end of the epochs
+checkpoint_steps = 0  # training batches, 0: no checkpoint inside the epochs
+
+# ------------- score cache ---------------------- #
+# save the sigmoid outputs and labels of every evaluation in score_dir,
+# as <exp_version>-<model_type>-<mode>-epoch<epoch>.scores.npy / .labels.npy
+# ("best" for the test of the best model, "<epoch>-subset" for the validate_subset
+# validations), read by Module/score_cache.py.
+score_cache = False
+score_dir = "./result/scores/"
+
 # ----------- model/train/test configuration ---- #
 """
 epoches = 50  # 50
@@ -94,6 +212,8 @@ attr_threshold = [0.5 for i in range(len(all_attrs))]
 sample_csv = pd.read_csv('sample_num.csv')
 attr_threshold = (sample_csv['positive sample']/(sample_csv['positive sample'] + sample_csv['negative sample'])).tolist()
 """
+# the thresholds chosen on the validate scores by calibrate.py, they replace attr_threshold.
+threshold_path = ""
 
 # -------------- Tensorboard --------------------- #
 use_tensorboard = False
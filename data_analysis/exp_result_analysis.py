@@ -1,6 +1,10 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
+import sys
+
+sys.path.append('..')
+from Module.metrics import confusion_metrics
 
 def show_eval_accuracy(eval_df, save_path):
     mean_acc_list = eval_df.describe().loc['mean'].tolist()
@@ -63,9 +67,9 @@ if __name__ == "__main__":
     matrix_df = pd.read_csv(matrix)
 
     
-    matrix_df['precision'] = matrix_df['TP'] / (matrix_df['TP'] + matrix_df['FP'])
-    matrix_df['recall'] = matrix_df['TP'] / (matrix_df['TP'] + matrix_df['FN'])
-    matrix_df['F1'] = 2 * matrix_df['precision'] * matrix_df['recall'] / (matrix_df['precision'] + matrix_df['recall'])
+    metrics = confusion_metrics(matrix_df['TP'], matrix_df['FP'], matrix_df['FN'], matrix_df['TN'], eps=0)
+    for key in ['precision', 'recall', 'F1']:
+        matrix_df[key] = metrics[key]
     print(matrix_df.describe())
     print("average accuracy: {}".format(acc))
 
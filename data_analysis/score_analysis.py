@@ -0,0 +1,72 @@
+import sys
+import argparse
+import pandas as pd
+import matplotlib.pyplot as plt
+
+sys.path.append('..')
+import config as cfg
+from Module.score_cache import score_prefix, cached_epochs, cached_metrics, load_scores
+from Module.calibration import load_thresholds
+from Module.ranking import ranking_curves, ranking_report
+
+"""
+Recompute the validate accuracy and mAP of every epoch, the test confusion
+matrix and the test PR/ROC curves of an experiment from the scores cached with
+`python main.py --score_cache`, without running the model again. The accuracy
+is over the evaluated images.
+"""
+
+def show_curves(scores, labels, attr_names, save_file_name):
+    curves = ranking_curves(scores, labels)
+    fig, (roc_ax, pr_ax) = plt.subplots(1, 2, figsize=(18, 8))
+    for attr, curve in zip(attr_names, curves):
+        roc_ax.plot(curve['fpr'], curve['tpr'], label=attr)
+        pr_ax.plot(curve['recall'], curve['precision'], label=attr)
+    roc_ax.set_xlabel('FPR')
+    roc_ax.set_ylabel('TPR')
+    roc_ax.set_title('The ROC curves')
+    pr_ax.set_xlabel('recall')
+    pr_ax.set_ylabel('precision')
+    pr_ax.set_title('The PR curves')
+    pr_ax.legend(fontsize=6, ncol=2)
+    roc_ax.grid(True)
+    pr_ax.grid(True)
+    plt.savefig(save_file_name)
+
+def thresholds_of(attr_names):
+    """
+    The thresholds of the attributes of the cached scores, in their order: the run
+    may have had other selected_attrs than config.py has now.
+    """
+    missing = [attr for attr in attr_names if attr not in cfg.selected_attrs]
+    assert len(missing) == 0, "no threshold in config.py for the cached attributes {}".format(missing)
+    default = [cfg.attr_threshold[cfg.selected_attrs.index(attr)] for attr in attr_names]
+    if args.threshold_path != '':
+        return load_thresholds(args.threshold_path, attr_names, default)
+    return default
+
+parser = argparse.ArgumentParser()
+parser.add_argument('exp_version', type=str)
+parser.add_argument('model_type', type=str)
+parser.add_argument('--score_dir', default='../result/scores/', type=str)
+parser.add_argument('--threshold_path', default='', type=str, help='the thresholds of calibrate.py')
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    for epoch in cached_epochs(args.score_dir, args.exp_version, args.model_type, 'validate'):
+        prefix = score_prefix(args.score_dir, args.exp_version, args.model_type, epoch, 'validate')
+        scores, labels, attr_names = load_scores(prefix)
+        _, _, mean_acc = cached_metrics(prefix, thresholds_of(attr_names))
+        report = ranking_report(scores, labels, attr_names)
+        print("epoch {}: mean accuracy {:.4f}, mAP {}, mean AUC {}".format(
+            epoch, mean_acc, report['mean_average_precision'], report['mean_roc_auc']))
+
+    test_prefix = score_prefix(args.score_dir, args.exp_version, args.model_type, 'best', 'test')
+    if 'best' in cached_epochs(args.score_dir, args.exp_version, args.model_type, 'test'):
+        scores, labels, attr_names = load_scores(test_prefix)
+        test_acc_dict, confusion_matrix_dict, mean_acc = cached_metrics(test_prefix, thresholds_of(attr_names))
+        matrix_df = pd.DataFrame(confusion_matrix_dict, index=list(test_acc_dict.keys()))
+        print(matrix_df.describe())
+        print("average accuracy: {}".format(mean_acc))
+        print(pd.DataFrame(ranking_report(scores, labels, attr_names))[['roc_auc', 'average_precision']].describe())
+        show_curves(scores, labels, attr_names, test_prefix + '-curves.png')
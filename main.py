@@ -6,6 +6,9 @@ import torch
 import pandas as pd
 import argparse
 from utils import seed_everything
+from Module.compile import GRAPH_MODES
+from Module.distributed import init_distributed, cleanup_distributed, is_main_process
+import config as cfg
 
 parser = argparse.ArgumentParser(description='FaceAtrr')
 parser.add_argument('--model_type', choices=[
@@ -26,6 +29,53 @@ parser.add_argument('--pretrained', action='store_true', default=True)
 parser.add_argument("--loss_type", choices=['BCE_loss', 'focal_loss'], default='BCE_loss')
 parser.add_argument("--exp_version",type=str, default="v7")
 parser.add_argument("--load_model_path", default="", type=str)
+parser.add_argument('--num_workers', default=cfg.num_workers, type=int, help='data loader workers')
+parser.add_argument('--prefetch_factor', default=cfg.prefetch_factor, type=int, help='batches prefetched by each worker')
+parser.add_argument('--persistent_workers', action='store_true', default=cfg.persistent_workers)
+parser.add_argument('--pin_memory', choices=[0, 1], default=int(cfg.pin_memory), type=int)
+parser.add_argument('--loader_autotune', action='store_true', default=cfg.loader_autotune,
+                    help='pick the fastest num_workers and prefetch_factor at startup')
+parser.add_argument('--batch_augment', action='store_true', default=cfg.batch_augment,
+                    help='augment the collated batches on the device instead of every image in the workers')
+parser.add_argument('--color_augment', action='store_true', default=cfg.color_augment,
+                    help='random photometric distortion of the batches, needs --batch_augment')
+parser.add_argument('--input_size', default=cfg.input_size, type=int, help='the input resolution of the model')
+parser.add_argument('--draft_decode', action='store_true', default=cfg.draft_decode,
+                    help='decode the jpg files at a reduced scale near input_size')
+parser.add_argument('--eval_cache', choices=['', 'uint8', 'float16'], default=cfg.eval_cache,
+                    help='keep the preprocessed validate/test images after the first evaluation')
+parser.add_argument('--eval_cache_budget', default=cfg.eval_cache_budget, type=float,
+                    help='GB of RAM per split for the eval cache, beyond it the cache is a memmap file')
+parser.add_argument('--eval_workers', default=cfg.eval_workers, type=int,
+                    help='evaluate the validate/test set in shards across this many cpu processes')
+parser.add_argument('--score_cache', action='store_true', default=cfg.score_cache,
+                    help='save the validate/test scores and labels of every evaluation in result/scores')
+parser.add_argument('--threshold_path', default=cfg.threshold_path, type=str,
+                    help='the per attribute thresholds written by calibrate.py')
+parser.add_argument('--async_validate', action='store_true', default=cfg.async_validate,
+                    help='validate every epoch in background processes while the next epoch trains')
+parser.add_argument('--validate_every', default=cfg.validate_every, type=int, help='validate every N epochs')
+parser.add_argument('--validate_subset', default=cfg.validate_subset, type=int,
+                    help='validate on a stratified subset of this many images, 0: the whole validate set')
+parser.add_argument('--bootstrap_samples', default=cfg.bootstrap_samples, type=int,
+                    help='bootstrap resamples for the interval of the validate accuracy, 0: none')
+parser.add_argument('--checkpoint_every', default=None, type=int,
+                    help='save the training state every N epochs, 0: never (default: config.py, 1 with --resume)')
+parser.add_argument('--checkpoint_steps', default=cfg.checkpoint_steps, type=int,
+                    help='save the training state every N batches, 0: never')
+parser.add_argument('--resume', action='store_true', default=False,
+                    help='continue the run of exp_version and model_type from its checkpoint')
+parser.add_argument('--amp', action='store_true', default=cfg.amp,
+                    help='mixed precision, bf16 on the cpu and fp16 on cuda')
+parser.add_argument('--channels_last', action='store_true', default=cfg.channels_last,
+                    help='run the model and the images in the channels last memory format')
+parser.add_argument('--graph_mode', default=cfg.graph_mode, choices=GRAPH_MODES,
+                    help='eager, torch.compile (compile) or frozen TorchScript for the evaluation (torchscript)')
+parser.add_argument('--distributed', action='store_true', default=cfg.distributed,
+                    help='DistributedDataParallel training, launched with torchrun; batch_size is per process')
+parser.add_argument('--dist_backend', default=cfg.dist_backend, type=str, help='the backend of the process group')
+parser.add_argument('--linear_probe', action='store_true', default=cfg.linear_probe,
+                    help='train only the classifier, on the cached features of the fixed trunk')
 args = parser.parse_args()
 
 epochs = args.epochs
@@ -39,17 +89,59 @@ loss_type = args.loss_type
 exp_version = args.exp_version
 model_path = args.load_model_path
 
+# the data loader settings are read by the solver from config.
+cfg.num_workers = args.num_workers
+cfg.prefetch_factor = args.prefetch_factor
+cfg.persistent_workers = args.persistent_workers
+cfg.pin_memory = bool(args.pin_memory)
+cfg.loader_autotune = args.loader_autotune
+cfg.batch_augment = args.batch_augment
+cfg.color_augment = args.color_augment
+cfg.input_size = args.input_size
+cfg.draft_decode = args.draft_decode
+cfg.eval_cache = args.eval_cache
+cfg.eval_cache_budget = args.eval_cache_budget
+cfg.eval_workers = args.eval_workers
+cfg.async_validate = args.async_validate
+cfg.validate_every = args.validate_every
+cfg.validate_subset = args.validate_subset
+cfg.bootstrap_samples = args.bootstrap_samples
+if args.checkpoint_every != None:
+    cfg.checkpoint_every = args.checkpoint_every
+elif args.resume:
+    # the resumed run keeps checkpointing, it can be interrupted and resumed again.
+    cfg.checkpoint_every = max(cfg.checkpoint_every, 1)
+cfg.amp = args.amp
+cfg.channels_last = args.channels_last
+cfg.graph_mode = args.graph_mode
+cfg.distributed = args.distributed
+cfg.dist_backend = args.dist_backend
+cfg.linear_probe = args.linear_probe
+cfg.checkpoint_steps = args.checkpoint_steps
+cfg.score_cache = args.score_cache
+cfg.threshold_path = args.threshold_path
+
 #--------------- exe ----------------------------- #
 if __name__ == "__main__":
     seed_everything()
+    if args.distributed:
+        init_distributed(args.dist_backend)
 
     # too more params to send.... not a good way....use the config.py to improve it
     solver = Solver(epoches=epochs, batch_size=batch_size, learning_rate=learning_rate, model_type=model_type,
                     optim_type=optim_type, momentum=momentum, pretrained=pretrained, loss_type=loss_type,
                     exp_version=exp_version)
+    if args.resume:
+        solver.resume()
     try:
         solver.fit(model_path=model_path)
-    except InterruptedError:
+    except (InterruptedError, KeyboardInterrupt):
         print("early stop...")
-        print("save the model dict....")
-        solver.save_model_dict(exp_version+"_"+model_path + "_earlystop.pth")
+        if is_main_process():
+            print("save the model dict....")
+            solver.save_model_dict(exp_version+"_"+model_path + "_earlystop.pth")
+        # the interrupted step is not saved, its batch is already drawn and the weights may be
+        # half updated: `--resume` continues from the last checkpoint of checkpoint_every/checkpoint_steps.
+        solver.checkpointer.wait()
+    finally:
+        cleanup_distributed()
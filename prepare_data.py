@@ -0,0 +1,32 @@
+import argparse
+import config as cfg
+from CelebA import build_label_cache, pack_images, decode_images, write_shards
+
+"""
+One-time conversions of the CelebA dataset, e.g.
+    python prepare_data.py labels
+    python prepare_data.py pack --pack_dir ../../dataset/CelebA/packed/
+    python prepare_data.py decode --num_workers 8
+    python prepare_data.py shards --shard_size 5000
+"""
+
+parser = argparse.ArgumentParser(description='Prepare the CelebA dataset')
+parser.add_argument('command', choices=['labels', 'pack', 'decode', 'shards'])
+parser.add_argument('--image_dir', default=cfg.image_dir, type=str)
+parser.add_argument('--attr_path', default=cfg.attr_path, type=str)
+parser.add_argument('--pack_dir', default=cfg.packed_dir, type=str)
+parser.add_argument('--decoded_dir', default=cfg.decoded_dir, type=str)
+parser.add_argument('--shard_dir', default=cfg.shard_dir, type=str)
+parser.add_argument('--shard_size', default=5000, type=int, help='images per tar shard')
+parser.add_argument('--num_workers', default=1, type=int)
+args = parser.parse_args()
+
+if __name__ == "__main__":
+    if args.command == 'labels':
+        build_label_cache(args.attr_path)
+    elif args.command == 'pack':
+        pack_images(args.image_dir, args.attr_path, args.pack_dir)
+    elif args.command == 'decode':
+        decode_images(args.image_dir, args.attr_path, args.decoded_dir, args.num_workers)
+    elif args.command == 'shards':
+        write_shards(args.image_dir, args.attr_path, args.shard_dir, args.shard_size)
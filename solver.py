@@ -11,15 +11,37 @@ import pandas as pd
 import matplotlib.pyplot as plt 
 import pandas as pd 
 
+import contextlib
 import copy
+import itertools
+import os
 import time
 import json
+import types
+import multiprocessing
 
-from CelebA import get_loader
+from CelebA import DATA_BACKENDS, get_loader, create_loader, autotune_loader
+from torch.utils.data import IterableDataset, Subset
+from torch.nn.parallel import DistributedDataParallel
 import torch.nn.functional as F
 import utils
 from FaceAttr_baseline_model import FaceAttrModel
 from Module.focal_loss import FocalLoss
+from Module.batch_augmentation import BatchAugmentation, ToUint8Tensor
+from Module.data_augmentation import BatchPhotometricDistort
+from Module.eval_cache import EvalCache
+from Module.metrics import MultiLabelMetrics
+from Module.score_cache import score_prefix, save_scores
+from Module.calibration import load_thresholds
+from Module.ranking import ranking_report
+from Module.validation import stratified_subset, image_accuracy, bootstrap_interval
+from Module.checkpoint import AsyncCheckpointer, load_checkpoint, rng_state, set_rng_state
+from Module.amp import autocast, grad_scaler
+from Module.compile import artifact_path, set_compile_cache, load_compiled, save_compiled, trace_model, freeze_model
+from Module.distributed import (get_rank, get_world_size, get_local_rank, barrier, all_reduce_sum,
+                                all_reduce_metrics, gather_batches, Logits)
+from Module.feature_cache import (weights_digest, feature_path, extract_features, merge_features, load_features,
+                                  FeatureDataset)
 import config as cfg
 
 
@@ -33,31 +55,161 @@ class Solver(object):
         self.learning_rate = learning_rate
         self.selected_attrs = cfg.selected_attrs
         self.momentum = momentum
-        self.device = torch.device("cuda:" + str(cfg.DEVICE_ID) if torch.cuda.is_available() else "cpu")
-        self.image_dir = cfg.image_dir
+        # the process of DistributedDataParallel (rank 0 of 1 without torchrun), only the rank 0 writes files.
+        self.rank, self.world_size = get_rank(), get_world_size()
+        self.is_main = self.rank == 0
+        # every rank takes the gpu of its local rank.
+        device_id = get_local_rank() if self.world_size > 1 else cfg.DEVICE_ID
+        self.device = torch.device("cuda:" + str(device_id) if torch.cuda.is_available() else "cpu")
+        self.data_backend = cfg.data_backend
+        self.image_dir = {"folder": cfg.image_dir, "packed": cfg.packed_dir,
+                          "decoded": cfg.decoded_dir, "stream": cfg.shard_dir}[self.data_backend]
         self.attr_path = cfg.attr_path
         self.pretrained = pretrained
         self.model_type = model_type
+        self.num_workers = cfg.num_workers
+        self.prefetch_factor = cfg.prefetch_factor
+        self.persistent_workers = cfg.persistent_workers
+        self.pin_memory = cfg.pin_memory and self.device.type == "cuda"
+        self.loader_autotune = cfg.loader_autotune
+        self.batch_augment = cfg.batch_augment
+        self.color_augment = cfg.color_augment
+        self.eval_cache = cfg.eval_cache
+        self.input_size = cfg.input_size
+        self.draft_decode = cfg.draft_decode
+        self.eval_workers = cfg.eval_workers
+        self.async_validate = cfg.async_validate
+        if self.world_size > 1 and (self.eval_workers > 1 or self.async_validate):
+            print("The ranks split the evaluation, eval_workers and async_validate are not used.")
+            self.eval_workers, self.async_validate = 1, False
+        # train and evaluate the FeatureClassfier on the cached features of the fixed trunk.
+        self.linear_probe = cfg.linear_probe
+        self.feature_dir = cfg.feature_dir
+        if self.linear_probe and self.data_backend == "stream":
+            raise ValueError("The linear probe reads the images by index, use the folder, packed or decoded backend.")
+        if self.linear_probe and (self.eval_workers > 1 or self.async_validate):
+            print("The linear probe evaluates from the cached features, eval_workers and async_validate are not used.")
+            self.eval_workers, self.async_validate = 1, False
+        self.validate_every = cfg.validate_every
+        self.validate_subset = cfg.validate_subset
+        self.bootstrap_samples = cfg.bootstrap_samples
+        self.confidence = cfg.confidence
+        self.checkpoint_every = cfg.checkpoint_every
+        self.checkpoint_steps = cfg.checkpoint_steps
+        self.checkpoint_path = os.path.join(cfg.checkpoint_dir,
+                                            "{}-{}-checkpoint.pth".format(exp_version, model_type))
+        self.checkpointer = AsyncCheckpointer()
+        self.resume_state = None
+        self.fit_state = None
+        self.train_position = {"epoch": 0, "batch": 0, "loss": 0.0}
+        self.sampler_seed = None
+        # the state of the train loader generator at the start of the epoch of train_position,
+        # the worker seeds of the epoch are drawn from it.
+        self.epoch_generator_state = None
+        self.resume_generator_state = None
+        self.pending_validations = []
+        self.score_cache = cfg.score_cache
+        self.score_dir = cfg.score_dir
+        self.batch_transform = None
+        self.speed_loaders = {}
+        self.amp = cfg.amp
+        self.memory_format = torch.channels_last if cfg.channels_last else torch.contiguous_format
+        self.graph_mode = cfg.graph_mode
+        self.compile_dir = cfg.compile_dir
+        self.eval_scores = None
         self.build_model(model_type, pretrained)
+        if self.linear_probe:
+            self.model.featureExtractor.requires_grad_(False)
+        self.build_graphs()
+        self.scaler = grad_scaler(self.device.type, self.amp)
         self.create_optim(optim_type)
         self.train_loader = None
         self.validate_loader = None
+        self.full_validate_loader = None
         self.test_loader = None
         self.log_dir = cfg.log_dir
         self.use_tensorboard = cfg.use_tensorboard
         self.attr_loss_weight = torch.tensor(cfg.attr_loss_weight).to(self.device)
         self.attr_threshold = cfg.attr_threshold
+        if cfg.threshold_path != "":
+            # the per attribute thresholds of calibrate.py
+            self.attr_threshold = load_thresholds(cfg.threshold_path, self.selected_attrs, cfg.attr_threshold)
         self.model_save_path = None
         self.LOADED = False
         self.start_time = 0
         self.loss_type = loss_type
         self.exp_version = exp_version
-        torch.cuda.set_device(cfg.DEVICE_ID)
+        if self.device.type == "cuda":
+            torch.cuda.set_device(self.device)
 
     def build_model(self, model_type, pretrained):
         """Here should change the model's structure""" 
         self.model = FaceAttrModel(model_type, pretrained, self.selected_attrs).to(self.device).to(self.device)
+        self.model.to(memory_format=self.memory_format)
         
+    def build_graphs(self):
+        """
+        The train logits and the eval forward of the model in graph_mode. The torch.compile
+        graphs share the parameters of self.model; the TorchScript ones are traced once
+        per input shape and frozen by inference_model, again only when the weights change.
+        With several ranks the train logits go through DistributedDataParallel, which
+        averages the gradients of the ranks. The linear probe trains and evaluates only
+        the FeatureClassfier, on the features (probe_forward).
+        """
+        trained = self.model.featureClassfier if self.linear_probe else self.model
+        self.train_logits = trained.logits
+        self.eval_forward = self.model
+        self.probe_forward = self.model.featureClassfier
+        self.ddp_model = None
+        self.traced_models = {}
+        self.frozen_models = {}
+        self.compiled_saved = set()
+        if self.world_size > 1:
+            device_ids = [self.device.index] if self.device.type == "cuda" else None
+            self.ddp_model = DistributedDataParallel(Logits(trained), device_ids=device_ids)
+            self.train_logits = self.ddp_model
+        if self.graph_mode == "compile":
+            set_compile_cache(self.compile_dir)
+            load_compiled(self.compile_path(self.batch_size, ".compiled"))
+            self.train_logits = torch.compile(self.train_logits)
+            self.eval_forward = torch.compile(self.model)
+            self.probe_forward = torch.compile(self.model.featureClassfier)
+
+    def compile_path(self, batch_size, extension):
+        shape = (batch_size, 3, self.input_size, self.input_size)
+        # the TorchScript graphs are traced in fp32, amp only applies to torch.compile.
+        return artifact_path(self.compile_dir, self.model_type, len(self.selected_attrs), shape, self.device.type,
+                             self.memory_format == torch.channels_last, self.eval_amp(), extension)
+
+    def eval_amp(self):
+        return self.amp and self.graph_mode != "torchscript"
+
+    def save_compiled(self, stage):
+        """Save the torch.compile artifacts once the first train step or eval batch has compiled them."""
+        if self.graph_mode == "compile" and self.is_main and stage not in self.compiled_saved:
+            save_compiled(self.compile_path(self.batch_size, ".compiled"))
+            self.compiled_saved.add(stage)
+
+    def inference_model(self, batch_size):
+        """
+        The eval forward, in torchscript graph_mode the graph traced for batches of batch_size
+        and frozen with the current weights. The frozen graph is kept until the weights change:
+        the optimizer steps, load_state_dict and the batch norm statistics all bump the
+        version counters of the tensors in the state_dict.
+        """
+        if self.graph_mode != "torchscript":
+            return self.eval_forward
+        state_dict = self.model.state_dict()
+        version = tuple(tensor._version for tensor in state_dict.values())
+        if batch_size in self.frozen_models and self.frozen_models[batch_size][0] == version:
+            return self.frozen_models[batch_size][1]
+        if batch_size not in self.traced_models:
+            example = torch.rand(batch_size, 3, self.input_size, self.input_size, device=self.device)
+            example = example.contiguous(memory_format=self.memory_format)
+            self.traced_models[batch_size] = trace_model(self.model, example, self.compile_path(batch_size, ".ts"))
+        self.frozen_models[batch_size] = (version, freeze_model(self.traced_models[batch_size], state_dict))
+        return self.frozen_models[batch_size][1]
+
     def create_optim(self, optim_type):
         scheduler = None
         if optim_type == "Adam":
@@ -70,6 +222,14 @@ class Solver(object):
             raise ValueError("no such a "+ optim_type + "optim, you can try Adam or SGD.")
 
     def set_transform(self, mode):
+        if self.batch_augment and mode != "predict":
+            # the workers only decode, the batch is transformed on the device after collation.
+            self.transform = None if self.data_backend == "decoded" else ToUint8Tensor()
+            color_jitter = BatchPhotometricDistort() if self.color_augment else None
+            self.batch_transform = BatchAugmentation(train=(mode == "train"),
+                                                     size=(self.input_size, self.input_size),
+                                                     color_jitter=color_jitter)
+            return
         transform = []
         if mode == 'train':
             transform.append(transforms.RandomHorizontalFlip())
@@ -80,7 +240,7 @@ class Solver(object):
             # transform.append(RandomSaturation())
         # the advising transforms way in imagenet
         # the input image should be resized as 224 * 224 for resnet.
-        transform.append(transforms.Resize(size=(224, 224))) # test no resize operation.
+        transform.append(transforms.Resize(size=(self.input_size, self.input_size))) # test no resize operation.
         transform.append(transforms.ToTensor())
         transform.append(transforms.Normalize(mean=[0.5, 0.5, 0.5],
                                 std=[0.5, 0.5, 0.5]))
@@ -89,18 +249,121 @@ class Solver(object):
         self.transform = transform
 
 
+    def build_loader(self, mode, batch_size):
+        return get_loader(image_dir = self.image_dir, attr_path = self.attr_path,
+                        selected_attrs = self.selected_attrs, mode = mode,
+                        batch_size = batch_size, transform = self.transform,
+                        backend = self.data_backend, num_workers = self.num_workers,
+                        pin_memory = self.pin_memory, prefetch_factor = self.prefetch_factor,
+                        persistent_workers = self.persistent_workers,
+                        decode_size = (self.input_size, self.input_size) if self.draft_decode else None,
+                        rank = self.rank, world_size = self.world_size)
+
+    def build_eval_loader(self, mode, subset=False):
+        """
+        With eval_cache, the preprocessed images are kept after the first evaluation.
+        subset: only the fixed stratified subset of validate_subset images.
+        The linear probe evaluates the cached features instead.
+        """
+        if self.linear_probe:
+            data_loader = self.build_feature_loader(mode)
+        else:
+            data_loader = self.build_loader(mode, self.batch_size)
+        name = "{}-{}-{}".format(self.exp_version, self.model_type, mode)
+        if subset and self.validate_subset > 0:
+            if isinstance(data_loader.dataset, IterableDataset):
+                print("The streamed {} dataset has no subset, it is used in full.".format(mode))
+            else:
+                if self.linear_probe:
+                    labels = data_loader.dataset.labels
+                else:
+                    labels = data_loader.dataset.split_dataset().label_matrix()
+                indices = stratified_subset(labels, self.validate_subset).tolist()
+                # the subset keeps its last partial batch: every image of the subset is scored,
+                # the images of the accuracy and of the bootstrap interval are the same.
+                data_loader = create_loader(Subset(data_loader.dataset, indices), self.batch_size, False,
+                                            self.num_workers, self.pin_memory,
+                                            self.prefetch_factor, self.persistent_workers, drop_last=False)
+                name += "-subset"
+        if self.world_size > 1:
+            # every rank evaluates its run of batches (the streamed shards are split by get_loader).
+            if not isinstance(data_loader.dataset, IterableDataset):
+                part = self.split_batches(len(data_loader.dataset), self.world_size)[self.rank]
+                data_loader = create_loader(Subset(data_loader.dataset, part.tolist()), self.batch_size, False,
+                                            self.num_workers, self.pin_memory,
+                                            self.prefetch_factor, self.persistent_workers, drop_last=False)
+            name += "-rank{}".format(self.rank)
+        if self.eval_cache == "" or self.linear_probe:
+            return data_loader
+        preprocess = None
+        if self.batch_augment:
+            batch_transform = self.batch_transform
+            preprocess = lambda images: batch_transform(images.to(self.device))
+        return EvalCache(data_loader, name,
+                        dtype=self.eval_cache, preprocess=preprocess,
+                        memory_budget=int(cfg.eval_cache_budget * 2**30), cache_dir=cfg.eval_cache_dir)
+
+    def build_feature_loader(self, mode):
+        """The loader of the cached features and labels of mode, with the train order of build_loader."""
+        return create_loader(self.feature_dataset(mode), self.batch_size, mode == "train", 0,
+                             rank=self.rank, world_size=self.world_size, drop_last=mode == "train")
+
+    def feature_dataset(self, mode):
+        """
+        The features of the fixed trunk for the images of mode, in an fp16 memmap of
+        feature_dir. They are extracted on the first use, with the eval preprocessing
+        (the train images are not augmented), and belong to the current trunk weights.
+        With several ranks every rank extracts a run of the images, which the rank 0
+        concatenates: no rank waits at a barrier for the extraction of the whole split.
+        """
+        self.set_transform("test")
+        dataset = DATA_BACKENDS[self.data_backend](self.attr_path, self.selected_attrs, self.image_dir,
+                                                   self.transform, mode,
+                                                   (self.input_size, self.input_size) if self.draft_decode else None)
+        labels = dataset.split_dataset().label_matrix()
+        path = feature_path(self.feature_dir, self.model_type, mode, self.input_size,
+                            weights_digest(self.model.featureExtractor))
+        if not os.path.exists(path):
+            parts = self.split_batches(len(dataset), self.world_size)
+            part_paths = ["{}.part{}".format(path, rank) for rank in range(self.world_size)]
+            if self.world_size == 1:
+                part_paths = [path]
+            training = self.model.training
+            self.model.eval()
+            if len(parts[self.rank]) > 0:
+                data_loader = create_loader(Subset(dataset, parts[self.rank].tolist()), self.batch_size, False,
+                                            self.num_workers, self.pin_memory, self.prefetch_factor, drop_last=False)
+                extract_features(self.trunk_features, data_loader, part_paths[self.rank], len(parts[self.rank]))
+            self.model.train(training)
+            if self.world_size > 1:
+                barrier()
+                if self.is_main:
+                    merge_features([part_path for part, part_path in zip(parts, part_paths) if len(part) > 0], path)
+                # the other ranks wait for the concatenation of the rank 0.
+                barrier()
+        return FeatureDataset(load_features(path), labels)
+
+    def trunk_features(self, images):
+        images = images.to(self.device, non_blocking=self.pin_memory)
+        if self.batch_augment:
+            images = self.batch_transform(images)
+        images = images.contiguous(memory_format=self.memory_format)
+        with autocast(self.device.type, self.amp):
+            return self.model.featureExtractor(images)
+
     # self define loss function
-    def BCE_loss(self, input_, target):
+    # the losses take the logits of the model and are computed in fp32, also under autocast.
+    def BCE_loss(self, logits, target):
         # cost_matrix = [1 for i in range(len(self.selected_attrs))]
-        loss = F.binary_cross_entropy(input_.to(self.device),  
-                                    target.type(torch.FloatTensor).to(self.device), 
-                                    weight=self.attr_loss_weight.type(torch.FloatTensor).to(self.device))
+        loss = F.binary_cross_entropy_with_logits(logits.float(),
+                                    target.to(self.device).float(),
+                                    weight=self.attr_loss_weight.float())
         return loss
 
-    def focal_loss(self, inputs, targets):
+    def focal_loss(self, logits, targets):
         focal_loss_func = FocalLoss()
         focal_loss_func.to(self.device)
-        return focal_loss_func(inputs, targets)
+        return focal_loss_func(logits, targets)
 
     def load_model_dict(self, model_state_dict_path):
         self.model_save_path = model_state_dict_path
@@ -111,8 +374,10 @@ class Solver(object):
         torch.save(self.model.state_dict(), model_state_dict_path)
         print("The model has saved!")
 
-    def train(self, epoch):
+    def train(self, epoch, start_batch=0, start_loss=0.0):
         """
+        start_batch, start_loss: the batches of this epoch already trained and the
+        sum of their losses, when resuming from a checkpoint.
         Return: the average trainging loss value of this epoch
         """
         self.model.train()
@@ -120,80 +385,129 @@ class Solver(object):
         self.set_transform("train")
 
         # to avoid loading dataset repeatedly
-        if self.train_loader == None:
-            self.train_loader = get_loader(image_dir = self.image_dir, attr_path = self.attr_path, 
-                                            selected_attrs = self.selected_attrs, mode="train", 
-                                            batch_size=self.batch_size, transform=self.transform)
+        if self.train_loader == None and self.linear_probe:
+            self.train_loader = self.build_feature_loader("train")
+            print("train_dataset size: {}".format(len(self.train_loader.dataset)))
+        elif self.train_loader == None:
+            self.train_loader = self.build_loader("train", self.batch_size)
+            if self.loader_autotune:
+                self.num_workers, self.prefetch_factor = autotune_loader(self.train_loader.dataset, 
+                                            self.batch_size, pin_memory=self.pin_memory)
+                self.train_loader = create_loader(self.train_loader.dataset, self.batch_size, True,
+                                            self.num_workers, self.pin_memory, 
+                                            self.prefetch_factor, self.persistent_workers,
+                                            self.rank, self.world_size)
             print("train_dataset size: {}".format(len(self.train_loader.dataset)))
 
-        temp_loss = 0.0
-            
-        for batch_idx, samples in enumerate(self.train_loader):
-            self.scheduler.step()
-
-            images, labels = samples
-            labels = torch.stack(labels).t() 
-            images= images.to(self.device)
-            outputs = self.model(images)
-            self.optim_.zero_grad()
-            if self.loss_type == "BCE_loss":
-                total_loss = self.BCE_loss(outputs, labels)  
-
-            elif self.loss_type == "focal_loss":
-                total_loss = self.focal_loss(outputs, labels)
-
-            total_loss.backward()
-            self.optim_.step()
-            temp_loss += total_loss.item()
+        batches = self.train_loader
+        if hasattr(self.train_loader.dataset, "set_epoch"):
+            # the streamed shards are shuffled per epoch, they restart from the beginning of the
+            # epoch: the batches already trained are read again and skipped.
+            self.train_loader.dataset.set_epoch(epoch)
+            if start_batch > 0:
+                print("Skip the {} streamed batches already trained in epoch {}".format(start_batch, epoch + 1))
+                batches = itertools.islice(self.train_loader, start_batch, None)
+        sampler = self.train_loader.sampler
+        if hasattr(sampler, "set_epoch"):
+            if self.sampler_seed != None:
+                sampler.seed = self.sampler_seed
+            self.sampler_seed = sampler.seed
+            sampler.set_epoch(epoch, start_batch * self.batch_size)
+        generator = self.train_loader.generator
+        if self.resume_generator_state != None:
+            generator.set_state(self.resume_generator_state)
+            self.resume_generator_state = None
+        self.epoch_generator_state = generator.get_state()
+        temp_loss = start_loss
+        self.train_position = {"epoch": epoch, "batch": start_batch, "loss": temp_loss}
             
-            if batch_idx % 50 == 0:
-                print("Epoch: {}/{}, training batch_idx : {}/{}, time: {}, loss: {}".format(epoch, self.epoches, 
-                                batch_idx, int(len(self.train_loader.dataset)/self.batch_size), 
-                                utils.timeSince(self.start_time), total_loss.item()))
+        # the streamed shards of the ranks can differ in length, join lets the ranks that ran
+        # out of batches shadow the gradient all-reduces of the others.
+        join = self.ddp_model.join() if self.ddp_model != None else contextlib.nullcontext()
+        with join:
+            for batch_idx, samples in enumerate(batches, start_batch):
+                self.scheduler.step()
 
-        return temp_loss/(batch_idx + 1)
+                images, labels = samples
+                images = images.to(self.device, non_blocking=self.pin_memory)
+                if not self.linear_probe:  # the features need no preprocessing
+                    if self.batch_augment:
+                        images = self.batch_transform(images)
+                    images = images.contiguous(memory_format=self.memory_format)
+                with autocast(self.device.type, self.amp):
+                    logits = self.train_logits(images)
+                self.optim_.zero_grad()
+                if self.loss_type == "BCE_loss":
+                    total_loss = self.BCE_loss(logits, labels)  
+
+                elif self.loss_type == "focal_loss":
+                    total_loss = self.focal_loss(logits, labels)
+
+                # the scaler only acts with fp16 on cuda.
+                self.scaler.scale(total_loss).backward()
+                self.scaler.step(self.optim_)
+                self.scaler.update()
+                self.save_compiled("train")
+                temp_loss += total_loss.item()
+                self.train_position = {"epoch": epoch, "batch": batch_idx + 1, "loss": temp_loss}
+                if self.checkpoint_steps > 0 and (batch_idx + 1) % self.checkpoint_steps == 0:
+                    self.save_checkpoint()
+            
+                if batch_idx % 50 == 0:
+                    print("Epoch: {}/{}, training batch_idx : {}/{}, time: {}, loss: {}".format(epoch, self.epoches, 
+                                    batch_idx, int(len(self.train_loader.dataset)/self.batch_size), 
+                                    utils.timeSince(self.start_time), total_loss.item()))
+
+        self.epoch_generator_state = generator.get_state()  # the next epoch starts from it
+        average_loss = temp_loss/max(self.train_position["batch"], 1)
+        if self.world_size > 1:
+            average_loss = all_reduce_sum(average_loss) / self.world_size
+        return average_loss
         
-    def evaluate(self, mode):
+    def evaluate(self, mode, epoch="best", full=False):
         """
         Mode: validate or test mode
+        epoch: the key of the cached scores, with score_cache (see score_epoch)
+        full: the whole validate set even with validate_subset
         Return: correct_dict: save the average predicting accuracy of every attribute
+        The outputs and labels are kept in self.eval_scores for the ranking metrics.
         """
         self.model.eval()
         self.set_transform(mode)
         data_loader = None
+        epoch = self.score_epoch(mode, epoch, full)
 
         if self.validate_loader == None and mode == "validate":
-            self.validate_loader = get_loader(image_dir = self.image_dir, 
-                                    attr_path = self.attr_path, 
-                                    selected_attrs = self.selected_attrs,
-                                    mode=mode, batch_size=self.batch_size, transform=self.transform)
+            self.validate_loader = self.build_eval_loader(mode, subset=True)
         elif self.test_loader == None and mode == "test":
-            self.test_loader = get_loader(image_dir = self.image_dir, 
-                                    attr_path = self.attr_path, 
-                                    selected_attrs = self.selected_attrs,
-                                    mode=mode, batch_size=self.batch_size, transform=self.transform)
-        if mode == 'validate':
+            self.test_loader = self.build_eval_loader(mode)
+        if mode == 'validate' and full and self.validate_subset > 0:
+            if self.full_validate_loader == None:
+                self.full_validate_loader = self.build_eval_loader(mode)
+            data_loader = self.full_validate_loader
+        elif mode == 'validate':
             data_loader = self.validate_loader
         elif mode == 'test':
             data_loader = self.test_loader
 
         print("{}_dataset size: {}".format(mode,len(data_loader.dataset)))
-        
-        correct_dict = {}
-        for attr in self.selected_attrs:
-            correct_dict[attr] = 0
-
-        confusion_matrix_dict = {}
-        confusion_matrix_dict['TP'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['TN'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['FP'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['FN'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['precision'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['recall'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['TPR'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['FPR'] = [0 for i in range(len(self.selected_attrs))]
-        confusion_matrix_dict['F1'] = [0 for i in range(len(self.selected_attrs))]
 
+        if self.eval_workers > 1:
+            shards = self.shard_tasks(mode, data_loader.dataset,
+                                      {k: v.cpu() for k, v in self.model.state_dict().items()})
+            # spawn, the forked copies of an OpenMP thread pool can deadlock.
+            pool = multiprocessing.get_context("spawn").Pool(self.eval_workers)
+            try:
+                states = pool.map(evaluate_shard, shards)
+            finally:
+                pool.close()
+                pool.join()
+            print("[{}]: {} shards evaluated, time: {}".format(mode, self.eval_workers,
+                                                               utils.timeSince(self.start_time)))
+            return self.merge_shards(mode, epoch, states)
+
+        scores, targets = [], []
+        metrics = MultiLabelMetrics(self.selected_attrs, self.attr_threshold, self.device)
         with torch.no_grad():
             for batch_idx, samples in enumerate(data_loader):
                 """
@@ -204,52 +518,171 @@ class Solver(object):
                     }
                 """
                 images, labels = samples
-                images = images.to(self.device)
-                labels = torch.stack(labels).t().tolist()
-                outputs = self.model(images)
-
-                for i in range(self.batch_size):
-                    for j, attr in enumerate(self.selected_attrs):
-                        pred = outputs[i].data[j]
-                        pred = 1 if pred > self.attr_threshold[j] else 0
-
-                        # record accuracy
-                        if pred == labels[i][j]:
-                            correct_dict[attr] = correct_dict[attr] + 1
-
-                        if pred == 1 and labels[i][j] == 1:
-                            confusion_matrix_dict['TP'][j] += 1  # TP
-                        if pred == 1 and labels[i][j] == 0:
-                            confusion_matrix_dict['FP'][j] += 1  # FP
-                        if pred == 0 and labels[i][j] == 1:
-                            confusion_matrix_dict['FN'][j] += 1  # TN  
-                        if pred == 0 and labels[i][j] == 0:
-                            confusion_matrix_dict['TN'][j] += 1  # FN
+                images = images.to(self.device, non_blocking=self.pin_memory)
+                if not self.linear_probe:
+                    if self.batch_augment and self.eval_cache == "":
+                        images = self.batch_transform(images)
+                    images = images.contiguous(memory_format=self.memory_format)
+                # the graph of the batch shape, the last batch of the split can be partial.
+                model = self.probe_forward if self.linear_probe else self.inference_model(images.shape[0])
+                with autocast(self.device.type, self.eval_amp()):
+                    outputs = model(images)
+                self.save_compiled("eval")
+                labels = labels.to(self.device, non_blocking=self.pin_memory)
+                metrics.update(outputs, labels)
+                scores.append(outputs)
+                targets.append(labels)
                 if batch_idx % 50 == 0:
                     print("[{}]: Batch_idx : {}/{}, time: {}".format(mode, 
                                 batch_idx, int(len(data_loader.dataset)/self.batch_size), 
                                 utils.timeSince(self.start_time)))
-            i = 0
-            # get the average accuracy
-            for attr in self.selected_attrs:
-                correct_dict[attr] = correct_dict[attr] * 100 / len(self.validate_loader.dataset)
-                confusion_matrix_dict['precision'][i] = confusion_matrix_dict['TP'][i]/(confusion_matrix_dict['FP'][i] 
-                                                        + confusion_matrix_dict['TP'][i] + 1e-6)
-                confusion_matrix_dict['recall'][i]= confusion_matrix_dict['TP'][i]/(confusion_matrix_dict['FN'][i] 
-                                                    + confusion_matrix_dict['TP'][i] + 1e-6)
-                confusion_matrix_dict['TPR'][i]= confusion_matrix_dict['TP'][i]/(confusion_matrix_dict['TP'][i] 
-                                                    + confusion_matrix_dict['FN'][i] + 1e-6)
-                confusion_matrix_dict['FPR'][i]= confusion_matrix_dict['FP'][i]/(confusion_matrix_dict['FP'][i] 
-                                                    + confusion_matrix_dict['TN'][i] + 1e-6)
-                confusion_matrix_dict['F1'][i] = 2*confusion_matrix_dict['precision'][i]*confusion_matrix_dict['recall'][i]/(confusion_matrix_dict['precision'][i] + confusion_matrix_dict['recall'][i] + 1e-6)                                                                          
-                i += 1
-            
-            mean_attributes_acc = 0.0
-            for k, v in correct_dict.items():
-                mean_attributes_acc += v
-            mean_attributes_acc /= len(self.selected_attrs)
+        if self.world_size > 1:
+            # every rank gets the metrics and the scores (in rank order) of the whole split.
+            all_reduce_metrics(metrics)
+            scores, targets = gather_batches(scores), gather_batches(targets)
+        return self.finish_evaluation(mode, epoch, metrics, scores, targets)
+
+    def score_epoch(self, mode, epoch, full=False):
+        """
+        The key of the cached scores of an evaluation: the validate subset scores get
+        "<epoch>-subset", so a full validation of the same epoch does not overwrite them.
+        """
+        if mode == "validate" and not full and self.validate_subset > 0:
+            return "{}-subset".format(epoch)
+        return epoch
+
+    def finish_evaluation(self, mode, epoch, metrics, scores, targets):
+        """
+        Keep and cache the scores, return the metrics of evaluate. The accuracy is of the
+        images scored (metrics.num_samples), the same images as the bootstrap interval.
+        """
+        self.eval_scores = (torch.cat(scores).cpu().numpy(), torch.cat(targets).cpu().numpy())
+        if self.score_cache and self.is_main:
+            prefix = score_prefix(self.score_dir, self.exp_version, self.model_type, epoch, mode)
+            save_scores(prefix, self.eval_scores[0], self.eval_scores[1], self.selected_attrs)
+            print("The {} scores are saved in {}".format(mode, prefix))
+
+        # get the average accuracy
+        return metrics.finalize()
+
+    def shard_tasks(self, mode, dataset, state_dict):
+        """
+        Split the batches of the dataset into eval_workers shards for evaluate_shard,
+        every shard is evaluated with its own copy of the model in a cpu process.
+        The shards cover the same images as the single process data loader.
+        """
+        num_shards = max(1, self.eval_workers)
+        indices = np.arange(len(dataset))
+        if isinstance(dataset, Subset):
+            indices = np.asarray(dataset.indices)
+        config_state = {}
+        for name, value in vars(cfg).items():
+            if not name.startswith("__") and not isinstance(value, types.ModuleType):
+                config_state[name] = value
+        shards = []
+        for i, part in enumerate(self.split_batches(len(dataset), num_shards)):
+            shards.append({
+                "index": i, "num_shards": num_shards,
+                "indices": indices[part].tolist(),
+                "mode": mode, "config": config_state, "state_dict": state_dict,
+                "model_type": self.model_type, "selected_attrs": self.selected_attrs,
+                "threshold": self.attr_threshold, "batch_size": self.batch_size,
+                "image_dir": self.image_dir, "attr_path": self.attr_path,
+                "backend": self.data_backend, "transform": self.transform,
+                "batch_transform": self.batch_transform if self.batch_augment else None,
+                "decode_size": (self.input_size, self.input_size) if self.draft_decode else None,
+                "num_threads": max(1, torch.get_num_threads() // num_shards),
+                "amp": self.amp, "channels_last": self.memory_format == torch.channels_last,
+                "graph_mode": self.graph_mode, "compile_dir": self.compile_dir, "input_size": self.input_size,
+            })
+        return shards
+
+    def split_batches(self, num_images, num_parts):
+        """
+        Split the positions of num_images into num_parts runs of whole batches. The last
+        run also takes the remainder, the partial batch of the single process loader.
+        """
+        num_batches = num_images // self.batch_size
+        bounds = np.linspace(0, num_batches, num_parts + 1).astype(int) * self.batch_size
+        bounds[-1] = num_images
+        return [np.arange(bounds[i], bounds[i + 1]) for i in range(num_parts)]
 
-        return correct_dict, confusion_matrix_dict, mean_attributes_acc
+    def merge_shards(self, mode, epoch, states):
+        """
+        Merge the results of evaluate_shard, in shard order so that the scores follow the dataset.
+        The accuracy is of the images the shards evaluated.
+        """
+        metrics = MultiLabelMetrics(self.selected_attrs, self.attr_threshold)
+        scores, targets = [], []
+        for state in states:
+            shard_metrics = MultiLabelMetrics(self.selected_attrs, self.attr_threshold)
+            shard_metrics.load_state_dict(state)
+            metrics.merge(shard_metrics)
+            scores.extend(state["scores"])
+            targets.extend(state["labels"])
+        return self.finish_evaluation(mode, epoch, metrics, scores, targets)
+
+    def validate_async(self, pool, epoch, weights=None):
+        """
+        Queue the validation of a snapshot of the current weights (or of weights) on
+        the processes of pool, while the training goes on. Return (epoch, weights, async result).
+        """
+        self.set_transform("validate")
+        if self.validate_loader == None:
+            self.validate_loader = self.build_eval_loader("validate", subset=True)
+        if weights == None:
+            weights = {k: v.detach().cpu().clone() for k, v in self.model.state_dict().items()}
+        shards = self.shard_tasks("validate", self.validate_loader.dataset, weights)
+        return epoch, weights, pool.map_async(evaluate_shard, shards)
+
+    def validate_weights(self, weights, epoch, full=False):
+        """The validation of weights, the current weights are restored after."""
+        current = {k: v.clone() for k, v in self.model.state_dict().items()}
+        self.model.load_state_dict(weights)
+        results = self.evaluate("validate", epoch, full=full)
+        self.model.load_state_dict(current)
+        return results
+
+    def save_checkpoint(self):
+        """
+        Queue the whole training state for the background writer, the training
+        goes on while it is written to checkpoint_path. The ranks have the same
+        state, only the rank 0 saves it.
+        """
+        if not self.is_main:
+            return
+        checkpoint = {
+            "position": dict(self.train_position, seed=self.sampler_seed),
+            "model": self.model.state_dict(),
+            "optimizer": self.optim_.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "rng": rng_state(),
+            "generator": self.epoch_generator_state,
+            "fit": self.fit_state,
+            # the async validations not consumed yet, they are queued again on resume.
+            "pending": [(epoch, weights) for epoch, weights, result in self.pending_validations],
+        }
+        self.checkpointer.save(checkpoint, self.checkpoint_path)
+        print("Epoch {}, batch {}: the checkpoint is queued for {}".format(
+                        self.train_position["epoch"] + 1, self.train_position["batch"], self.checkpoint_path))
+
+    def resume(self, checkpoint_path=None):
+        """Load a checkpoint, fit continues from it."""
+        self.resume_state = load_checkpoint(checkpoint_path or self.checkpoint_path)
+        print("The checkpoint {} has loaded!".format(checkpoint_path or self.checkpoint_path))
+
+    def restore_checkpoint(self, checkpoint):
+        self.model.load_state_dict(checkpoint["model"])
+        self.optim_.load_state_dict(checkpoint["optimizer"])
+        self.scheduler.load_state_dict(checkpoint["scheduler"])
+        if checkpoint.get("scaler"):
+            self.scaler.load_state_dict(checkpoint["scaler"])
+        set_rng_state(checkpoint["rng"])
+        self.resume_generator_state = checkpoint.get("generator")
+        self.fit_state = checkpoint["fit"]
+        self.train_position = dict(checkpoint["position"])
+        self.sampler_seed = self.train_position.pop("seed")
 
 
     def fit(self, model_path=""):
@@ -264,66 +697,144 @@ class Solver(object):
             self.load_model_dict(model_path)
             print("The model has loaded the state dict on {}".format(model_path))
 
-        train_losses = []
-
-        best_model_wts = copy.deepcopy(self.model.state_dict())
-        best_acc = 0.0
+        # everything of fit that a checkpoint needs to resume.
+        state = self.fit_state = {
+            "train_losses": [],
+            "best_model_wts": copy.deepcopy(self.model.state_dict()),
+            "best_acc": 0.0,
+            "best_epoch": None,
+            "best_interval": None,  # the bootstrap interval of best_acc on the validate subset
+            "best_full_acc": None,  # the accuracy of the best model on the whole validate set, if measured
+            "eval_acc_dict": {},  # epoch: the accuracy of every attribute, for the validated epochs
+            "confusion_matrix_df": None,
+        }
         self.scheduler.step()
-        eval_acc_dict = {}
-        confusion_matrix_df = None 
-
-        for attr in self.selected_attrs:
-            eval_acc_dict[attr] = []
-        self.start_time = time.time()
-        for epoch in range(self.epoches):
-            running_loss = self.train(epoch)
-            print("{}/{} Epoch:  in training process average loss: {:.4f}".format(epoch + 1, self.epoches, running_loss))
-            print("The running time since the start is : {} ".format(utils.timeSince(self.start_time)))
-            average_acc_dict, confusion_matrix_dict, mean_attributes_acc = self.evaluate("validate")
+        self.train_position = {"epoch": 0, "batch": 0, "loss": 0.0}
+        resumed_pending = []
+        if self.resume_state != None:
+            self.restore_checkpoint(self.resume_state)
+            state = self.fit_state
+            resumed_pending = self.resume_state["pending"]
+            self.resume_state = None
+            print("Resume from epoch {}, batch {}".format(self.train_position["epoch"] + 1, self.train_position["batch"]))
+
+        def record_validation(epoch, results, weights):
+            average_acc_dict, confusion_matrix_dict, mean_attributes_acc = results
             print("{}/{} Epoch: in evaluating process average accuracy:{}".format(epoch + 1, self.epoches, average_acc_dict))
             print("{}/{} Epoch: the mean accuracy is {}".format(epoch+1, self.epoches, mean_attributes_acc))
+            interval = None
+            if self.bootstrap_samples > 0:
+                interval = bootstrap_interval(image_accuracy(self.eval_scores[0], self.eval_scores[1], self.attr_threshold),
+                                              self.bootstrap_samples, self.confidence)
+                print("{}/{} Epoch: the {}% interval of the mean accuracy is [{:.4f}, {:.4f}]".format(
+                                epoch + 1, self.epoches, self.confidence * 100, interval[0], interval[1]))
             print("The running time since the start is : {} ".format(utils.timeSince(self.start_time)))
-            train_losses.append(running_loss)
-            average_acc = 0.0
 
-            # Record the evaluating accuracy of every attribute at current epoch
-            for attr in self.selected_attrs:
-                eval_acc_dict[attr].append(average_acc_dict[attr])
-                average_acc += average_acc_dict[attr]
-            average_acc /= len(self.selected_attrs) # overall accuracy
-            
-            # find a better model, save it 
-            if average_acc > best_acc and epoch > self.epoches / 2: # for save time 
-                best_acc = average_acc
-                best_model_wts = copy.deepcopy(self.model.state_dict())
-                confusion_matrix_df = pd.DataFrame(confusion_matrix_dict, index=self.selected_attrs)
+            if epoch > self.epoches / 2: # for save time 
+                full_acc = None
+                best_interval = state["best_interval"]
+                if (self.validate_subset > 0 and interval != None and best_interval != None
+                        and interval[0] <= best_interval[1] and best_interval[0] <= interval[1]):
+                    # too close to tell apart on the subset, compare both on the whole validate set.
+                    if state["best_full_acc"] == None:
+                        state["best_full_acc"] = self.validate_weights(state["best_model_wts"], state["best_epoch"], full=True)[2]
+                    results = self.validate_weights(weights, epoch, full=True)
+                    average_acc_dict, confusion_matrix_dict, full_acc = results
+                    print("{}/{} Epoch: the mean accuracy on the whole validate set is {}, the best is {}".format(
+                                    epoch + 1, self.epoches, full_acc, state["best_full_acc"]))
+                    better = full_acc > state["best_full_acc"]
+                else:
+                    better = mean_attributes_acc > state["best_acc"]
+                # find a better model, save it 
+                if better:
+                    state["best_acc"] = mean_attributes_acc
+                    state["best_epoch"] = epoch
+                    state["best_interval"] = interval
+                    state["best_full_acc"] = full_acc
+                    state["best_model_wts"] = copy.deepcopy(weights)
+                    state["confusion_matrix_df"] = pd.DataFrame(confusion_matrix_dict, index=self.selected_attrs)
 
-        # save the accuracy in files
-        eval_acc_csv = pd.DataFrame(eval_acc_dict, index = [i for i in range(self.epoches)]).T 
-        eval_acc_csv.to_csv("./result/" + self.exp_version + '-' +  self.model_type + "-eval_accuracy"+ ".csv");
+            # Record the evaluating accuracy of every attribute at current epoch
+            state["eval_acc_dict"][epoch] = average_acc_dict
 
-        # save the loss files
-        train_losses_csv = pd.DataFrame(train_losses)
-        train_losses_csv.to_csv("./result/" + self.exp_version + '-' +  self.model_type + "-losses" +".csv")
+        pool = None
+        self.pending_validations = []
+        if self.async_validate:
+            # the snapshot of every epoch is validated in these processes while the next epoch trains.
+            pool = multiprocessing.get_context("spawn").Pool(max(1, self.eval_workers))
+        self.start_time = time.time()
+        for epoch, weights in resumed_pending:
+            if pool != None:
+                self.pending_validations.append(self.validate_async(pool, epoch, weights))
+            else:
+                record_validation(epoch, self.validate_weights(weights, epoch), weights)
+        try:
+            for epoch in range(self.train_position["epoch"], self.epoches):
+                position = self.train_position
+                if position["epoch"] == epoch:
+                    running_loss = self.train(epoch, position["batch"], position["loss"])
+                else:
+                    running_loss = self.train(epoch)
+                print("{}/{} Epoch:  in training process average loss: {:.4f}".format(epoch + 1, self.epoches, running_loss))
+                print("The running time since the start is : {} ".format(utils.timeSince(self.start_time)))
+                state["train_losses"].append(running_loss)
+                validate = (epoch + 1) % self.validate_every == 0 or epoch == self.epoches - 1
+                if validate and pool == None:
+                    record_validation(epoch, self.evaluate("validate", epoch), self.model.state_dict())
+                elif validate:
+                    self.pending_validations.append(self.validate_async(pool, epoch))
+                # consume the finished validations in epoch order, wait for all of them after the last epoch.
+                pending = self.pending_validations
+                while pending and (pending[0][2].ready() or epoch == self.epoches - 1):
+                    done_epoch, weights, result = pending.pop(0)
+                    results = self.merge_shards("validate", self.score_epoch("validate", done_epoch), result.get())
+                    record_validation(done_epoch, results, weights)
+                self.train_position = {"epoch": epoch + 1, "batch": 0, "loss": 0.0}
+                if self.checkpoint_every > 0 and (epoch + 1) % self.checkpoint_every == 0:
+                    self.save_checkpoint()
+        finally:
+            if pool != None:
+                pool.terminate()
+                pool.join()
+        self.checkpointer.wait()
+
+        train_losses = state["train_losses"]
+        best_model_wts = state["best_model_wts"]
+        best_epoch = state["best_epoch"]
+        # every rank has the same results, the rank 0 writes them.
+        if self.is_main:
+            # save the accuracy in files, nan for the epochs without validation
+            eval_acc_csv = pd.DataFrame(state["eval_acc_dict"], index=self.selected_attrs, columns=[i for i in range(self.epoches)])
+            eval_acc_csv.to_csv("./result/" + self.exp_version + '-' +  self.model_type + "-eval_accuracy"+ ".csv");
+
+            # save the loss files
+            train_losses_csv = pd.DataFrame(train_losses)
+            train_losses_csv.to_csv("./result/" + self.exp_version + '-' +  self.model_type + "-losses" +".csv")
 
         # load best model weights
         self.model_save_path = "./result/" + self.exp_version + '-' +  self.model_type + "-best_model_params" + ".pth"
         self.model.load_state_dict(best_model_wts)
         self.LOADED = True
-        torch.save(best_model_wts, self.model_save_path)        
-        print("The model has saved in {}".format(self.model_save_path))
+        if self.is_main:
+            torch.save(best_model_wts, self.model_save_path)        
+            print("The model has saved in {}".format(self.model_save_path))
         # test the model with test dataset.
-        test_acc_dict, confusion_matrix_dict, mean_attributes_acc = self.evaluate("test")
-        test_acc_csv = pd.DataFrame(test_acc_dict, index=['accuracy'])
-        test_acc_csv.to_csv("./result/" + self.exp_version + '-' + self.model_type + "-test_accuracy" + '.csv')
-        test_confusion_matrix_csv = pd.DataFrame(confusion_matrix_dict, index=self.selected_attrs)
-        test_confusion_matrix_csv.to_csv("./result/" + self.exp_version + '-' + self.model_type + '-confusion_matrix.csv', index=self.selected_attrs)
-
+        test_acc_dict, confusion_matrix_dict, mean_attributes_acc = self.evaluate("test", "best")
         report_dict = {}
         report_dict["model"] = self.model_type
         report_dict["version"] = self.exp_version
         report_dict["mean_attributes_accuracy"] = mean_attributes_acc
+        report_dict["best_epoch"] = best_epoch
+        # the threshold free metrics of the test scores.
+        report_dict.update(ranking_report(self.eval_scores[0], self.eval_scores[1], self.selected_attrs))
         report_dict["speed"] = self.test_speed()
+        if not self.is_main:
+            return
+        test_acc_csv = pd.DataFrame(test_acc_dict, index=['accuracy'])
+        test_acc_csv.to_csv("./result/" + self.exp_version + '-' + self.model_type + "-test_accuracy" + '.csv')
+        test_confusion_matrix_csv = pd.DataFrame(confusion_matrix_dict, index=self.selected_attrs)
+        test_confusion_matrix_csv.to_csv("./result/" + self.exp_version + '-' + self.model_type + '-confusion_matrix.csv', index=self.selected_attrs)
+
         report_json = json.dumps(report_dict)
         report_file = open("./result/" + self.exp_version + "-" + self.model_type + "-report.json", 'w')
         report_file.write(report_json)
@@ -355,20 +866,28 @@ class Solver(object):
             print("You load the model params: {}".format(model_path))
 
         self.model.eval()
+        model = self.inference_model(image_num)
 
         with torch.no_grad():
             self.set_transform(mode="test")
-            self.test_loader = get_loader(image_dir = self.image_dir, 
-                                    attr_path = self.attr_path, 
-                                    selected_attrs = self.selected_attrs,
-                                    mode="test", batch_size=image_num, transform=self.transform)
+            # keep the loader of every image_num, instead of building the test set again on each call.
+            if image_num not in self.speed_loaders:
+                self.speed_loaders[image_num] = self.build_loader("test", image_num)
             
-            for idx, samples in enumerate(self.test_loader):
+            for idx, samples in enumerate(self.speed_loaders[image_num]):
                 images, labels = samples
                 images = images.to(self.device)
-                labels = torch.stack(labels).t().tolist()
+                labels = labels.tolist()
+                if self.batch_augment:
+                    images = self.batch_transform(images)
+                images = images.contiguous(memory_format=self.memory_format)
+                if self.graph_mode != "eager":
+                    # the first calls compile (or optimize) the graph.
+                    with autocast(self.device.type, self.eval_amp()):
+                        model(images)
                 start_time = time.time()
-                outputs = self.model(images)
+                with autocast(self.device.type, self.eval_amp()):
+                    outputs = model(images)
                 end_time = time.time()
 
                 if idx == 0:
@@ -376,4 +895,71 @@ class Solver(object):
                     print("You test {} images. The cost time is {}. The speed is {} images/s.".format(image_num,(end_time - start_time),speed))
                     print("---------------------------------------------------------")
                     return end_time-start_time
-                    break
\ No newline at end of file
+
+
+def evaluate_shard(shard):
+    """
+    Evaluate the images at indices of a split on the cpu, in a worker process
+    of Solver.evaluate and validate_async. Return the state of the MultiLabelMetrics,
+    with the batches of outputs and labels.
+    """
+    # the spawned process starts from the defaults of config.py.
+    vars(cfg).update(shard["config"])
+    torch.set_num_threads(shard["num_threads"])
+    model = FaceAttrModel(shard["model_type"], False, shard["selected_attrs"])
+    model.load_state_dict(shard["state_dict"])
+    model.eval()
+    memory_format = torch.channels_last if shard["channels_last"] else torch.contiguous_format
+    model.to(memory_format=memory_format)
+    amp = shard["amp"]
+    shape = (shard["batch_size"], 3, shard["input_size"], shard["input_size"])
+    forwards = {}
+
+    def forward_of(batch_size):
+        """The model, in torchscript graph_mode the graph frozen for batches of batch_size."""
+        if shard["graph_mode"] != "torchscript":
+            return model
+        if batch_size not in forwards:
+            batch_shape = (batch_size,) + shape[1:]
+            example = torch.rand(batch_shape).contiguous(memory_format=memory_format)
+            path = artifact_path(shard["compile_dir"], shard["model_type"], len(shard["selected_attrs"]), batch_shape,
+                                 "cpu", shard["channels_last"], False, ".ts")
+            forwards[batch_size] = freeze_model(trace_model(model, example, path), shard["state_dict"])
+        return forwards[batch_size]
+
+    if shard["graph_mode"] == "torchscript":
+        amp = False  # traced in fp32
+    elif shard["graph_mode"] == "compile":
+        path = artifact_path(shard["compile_dir"], shard["model_type"], len(shard["selected_attrs"]), shape, "cpu",
+                             shard["channels_last"], amp, ".compiled")
+        set_compile_cache(shard["compile_dir"])
+        load_compiled(path)
+        model = torch.compile(model)
+
+    dataset = DATA_BACKENDS[shard["backend"]](shard["attr_path"], shard["selected_attrs"], shard["image_dir"],
+                                              shard["transform"], shard["mode"], shard["decode_size"])
+    if isinstance(dataset, IterableDataset):
+        # the tar shards are split by file instead.
+        dataset.rank, dataset.world_size = shard["index"], shard["num_shards"]
+    else:
+        dataset = Subset(dataset, shard["indices"])
+    # every shard keeps its last partial batch, like the loaders of evaluate.
+    data_loader = create_loader(dataset, shard["batch_size"], False, num_workers=0, drop_last=False)
+
+    metrics = MultiLabelMetrics(shard["selected_attrs"], shard["threshold"])
+    scores, targets = [], []
+    with torch.no_grad():
+        for images, labels in data_loader:
+            if shard["batch_transform"] != None:
+                images = shard["batch_transform"](images)
+            images = images.contiguous(memory_format=memory_format)
+            with autocast("cpu", amp):
+                outputs = forward_of(images.shape[0])(images)
+            if shard["graph_mode"] == "compile" and shard["index"] == 0 and len(scores) == 0:
+                save_compiled(path)
+            metrics.update(outputs, labels)
+            scores.append(outputs)
+            targets.append(labels)
+    state = metrics.state_dict()
+    state["scores"], state["labels"] = scores, targets
+    return state